@@ -1,43 +1,237 @@
 import logging
 import json
+import asyncio
 import azure.functions as func
+from concurrent.futures import ThreadPoolExecutor
 
-from . import bm25
+from . import ranker
 from . import retriever
 from . import reader
 from . import helper
+from . import cache
+from . import pipeline
+from . import batch
+from . import telemetry
+from . import batcher
+from . import coalesce
+
+# Reader inference of the async entry point runs here, so the event loop stays responsive
+executor = ThreadPoolExecutor(max_workers=int(helper.get_setting('async', 'reader_workers', 4)), thread_name_prefix='mrc-reader')
+
+# Identical questions that arrive while the first one is answered wait for its answers
+coalescer = coalesce.SingleFlight() if str(helper.get_setting('coalesce', 'enabled', 'true')).lower() == 'true' else None
+
+def get_cached(question, params):
+    ''' Cached response to the question, if the same question was asked before '''
+    if cache.answers is None:
+        return None
+    res = cache.answers.get(cache.answer_key(question, *params))
+    if res is not None:
+        telemetry.count('cache.answer_hits')
+        logging.info(f'Answered from cache: {cache.answers.stats()}')
+    return res
+
+def set_cached(question, params, res):
+    if cache.answers is not None:
+        cache.answers.set(cache.answer_key(question, *params), res)
+        logging.info(f'Answer cache: {cache.answers.stats()}, span cache: {cache.spans.stats()}')
+
+def format_response(documents, answers, reader_stats=None):
+    res = dict(
+        answers = answers,
+        counts = dict(
+            documents = len(documents),
+            answers = len(answers)
+        )
+    )
+    if reader_stats is not None:
+        # Documents and tokens the adaptive reader read, and the share of compute saved
+        res['reader'] = reader_stats
+    return json.dumps(res)
+
+def add_timings(res, trace, timings):
+    ''' Response with the timings and counters of the request so far, if asked for '''
+    if not timings:
+        return res
+    return json.dumps(dict(json.loads(res), timings = trace.timings()))
+
+def read(question, documents, sources, model, adaptive):
+    ''' Answers of the reader, with the saved compute if it reads adaptively '''
+    if adaptive:
+        return reader.main_adaptive(question, documents, sources, model)
+    return reader.main(question, documents, sources, model), None
+
+def compute_answers(question, n_doc, treshold, tokenize, bm_n_doc, model, adaptive):
+    ''' Response to a question from the retriever, the ranker and the reader, it is cached '''
+    # Fetch relevant documents, if any
+    documents, sources = retriever.main(question, n_doc, treshold, tokenize)
+
+    # Apply BM25 (and the dense ranking, if enabled), if more than n documents
+    if documents and len(documents) > bm_n_doc:
+        documents, sources = ranker.main(question, documents, sources, bm_n_doc)
+
+    # Extract relevant answers, if any
+    if documents:
+        answers, reader_stats = read(question, documents, sources, model, adaptive)
+    else:
+        answers, reader_stats = [], None
+
+    # Format response
+    res = format_response(documents, answers, reader_stats)
+    set_cached(question, (n_doc, treshold, tokenize, bm_n_doc, model, adaptive), res)
+    return res
+
+async def compute_answers_async(question, n_doc, treshold, tokenize, bm_n_doc, model, adaptive):
+    ''' Like `compute_answers`, the search request is awaited and the reader runs in the executor '''
+    # Fetch relevant documents, if any
+    documents, sources = await retriever.main_async(question, n_doc, treshold, tokenize)
+
+    # Apply BM25 (and the dense ranking, if enabled), if more than n documents
+    # Ranking and reading run in the executor, so they do not block the other requests on the event loop
+    loop = asyncio.get_running_loop()
+    if documents and len(documents) > bm_n_doc:
+        documents, sources = await loop.run_in_executor(executor, telemetry.wrap(ranker.main), question, documents, sources, bm_n_doc)
+
+    # Extract relevant answers, if any
+    if documents:
+        answers, reader_stats = await loop.run_in_executor(executor, telemetry.wrap(read), question, documents, sources, model, adaptive)
+    else:
+        answers, reader_stats = [], None
+
+    # Format response
+    res = format_response(documents, answers, reader_stats)
+    set_cached(question, (n_doc, treshold, tokenize, bm_n_doc, model, adaptive), res)
+    return res
+
+def flight_key(question, params):
+    ''' Key of the copies of a request in flight, only the exact same question and parameters are coalesced '''
+    return cache.get_key(question, *params)
+
+def answer(question, params):
+    ''' Response to a question, computed once for all copies of it that are in flight at the same time '''
+    if coalescer is None:
+        return compute_answers(question, *params)
+    res = coalescer.do(flight_key(question, params), compute_answers, question, *params)
+    logging.info(f'Request coalescing: {coalescer.stats()}')
+    return res
+
+async def answer_async(question, params):
+    ''' Like `answer`, copies of the question from the sync entry point are coalesced as well '''
+    if coalescer is None:
+        return await compute_answers_async(question, *params)
+    res = await coalescer.do_async(flight_key(question, params), compute_answers_async, question, *params)
+    logging.info(f'Request coalescing: {coalescer.stats()}')
+    return res
+
+def stream_response(question, n_doc, treshold, tokenize, model, max_answers, min_score, trace=None):
+    ''' Answers of the streaming pipeline as NDJSON, one answer per line and the counts last, with the timings of the trace if given '''
+    lines = list(pipeline.stream_answers(question, n_doc, treshold, tokenize, model, max_answers, min_score))
+    if trace is not None:
+        lines[-1]['timings'] = trace.timings()
+    return "".join(pipeline.to_ndjson(lines))
+
+def batch_response(questions, n_doc, treshold, tokenize, bm_n_doc, model):
+    ''' Answers per question of a batch request, in the order of the questions, cached questions are not answered again '''
+    # Batch requests are read in full, they share the cache entries of such single requests
+    params = (n_doc, treshold, tokenize, bm_n_doc, model, False)
+    results = {}
+    for question in questions:
+        res = get_cached(question, params)
+        if res is not None:
+            results[question] = dict(question = question, **json.loads(res))
+    missing = [question for question in dict.fromkeys(questions) if question not in results]
+    if missing:
+        for result in batch.answer_questions(missing, n_doc, treshold, tokenize, bm_n_doc, model):
+            results[result['question']] = result
+            set_cached(result['question'], params, json.dumps(dict(answers = result['answers'], counts = result['counts'])))
+    return json.dumps(dict(
+        results = [results[question] for question in questions],
+        counts = dict(
+            questions = len(questions)
+        )
+    ))
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     # Collect parameters
-    question, n_doc, treshold, tokenize, bm_n_doc = helper.get_config(req)
-
-    if question:
-        # Fetch relevant documents, if any
-        documents, sources = retriever.main(question, n_doc, treshold, tokenize)
-
-        # Apply BM25, if more than n documents
-        if documents and len(documents) > bm_n_doc:
-            documents, sources = bm25.main(question, documents, sources, bm_n_doc)
-
-        # Extract relevant answers, if any
-        if documents:
-            answers = reader.main(question, documents, sources)
-        else:
-            answers = []
-
-        # Format response
-        res = json.dumps(dict(
-            answers = answers,
-            counts = dict(
-                documents = len(documents),
-                answers = len(answers)
-            )
-        ))
-        return func.HttpResponse(res, mimetype='application/json')
-    else:
-        return func.HttpResponse(
-             "This HTTP triggered function executed successfully. Pass a question in the query string or in the request body for a personalized response.",
-             status_code=200
-        )
+    question, n_doc, treshold, tokenize, bm_n_doc, model = helper.get_config(req)
+    stream, max_answers, min_score = helper.get_stream_config(req)
+    questions = helper.get_questions(req)
+    adaptive = helper.get_adaptive(req)
+    timings = helper.get_timings(req)
+
+    # Time the stages of the request, the trace is exported once the response is ready
+    with telemetry.trace('MRC') as trace:
+        try:
+            if questions:
+                # Answer all questions of a batch request at once
+                res = batch_response(questions, n_doc, treshold, tokenize, bm_n_doc, model)
+                return func.HttpResponse(add_timings(res, trace, timings), mimetype='application/json')
+            elif question and stream:
+                # Read snippets as they arrive and stop early, once enough confident answers are found
+                res = stream_response(question, n_doc, treshold, tokenize, model, max_answers, min_score, trace if timings else None)
+                return func.HttpResponse(res, mimetype='application/x-ndjson')
+            elif question:
+                # Return the cached answers, if the same question was asked before
+                params = (n_doc, treshold, tokenize, bm_n_doc, model, adaptive)
+                res = get_cached(question, params)
+                if res is None:
+                    # Copies of the question that are in flight share the answers of the first one
+                    res = answer(question, params)
+                return func.HttpResponse(add_timings(res, trace, timings), mimetype='application/json')
+            else:
+                return func.HttpResponse(
+                     "This HTTP triggered function executed successfully. Pass a question in the query string or in the request body for a personalized response.",
+                     status_code=200
+                )
+        except batcher.Overloaded as e:
+            # Shed load early instead of queuing, the client may retry shortly
+            logging.warning(f'[INFO] - Rejected request: {e}')
+            return func.HttpResponse("The reader is busy, please retry.", status_code=503, headers={'Retry-After': '1'})
+
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    '''
+    Async variant of `main`, set `"entryPoint": "main_async"` in the function.json to use it.
+    The search request is awaited on a shared async client and the reader runs in the executor,
+    so one worker handles many overlapping requests.
+    '''
+    logging.info('Python HTTP trigger function processed a request.')
+
+    # Collect parameters
+    question, n_doc, treshold, tokenize, bm_n_doc, model = helper.get_config(req)
+    stream, max_answers, min_score = helper.get_stream_config(req)
+    questions = helper.get_questions(req)
+    adaptive = helper.get_adaptive(req)
+    timings = helper.get_timings(req)
+
+    # Time the stages of the request, the trace is exported once the response is ready
+    with telemetry.trace('MRC') as trace:
+        try:
+            if questions:
+                # Batch requests search and read in the executor
+                loop = asyncio.get_running_loop()
+                res = await loop.run_in_executor(executor, telemetry.wrap(batch_response), questions, n_doc, treshold, tokenize, bm_n_doc, model)
+                return func.HttpResponse(add_timings(res, trace, timings), mimetype='application/json')
+            elif question and stream:
+                # The streaming pipeline searches and reads in the executor
+                loop = asyncio.get_running_loop()
+                res = await loop.run_in_executor(executor, telemetry.wrap(stream_response), question, n_doc, treshold, tokenize, model, max_answers, min_score, trace if timings else None)
+                return func.HttpResponse(res, mimetype='application/x-ndjson')
+            elif question:
+                # Return the cached answers, if the same question was asked before
+                params = (n_doc, treshold, tokenize, bm_n_doc, model, adaptive)
+                res = get_cached(question, params)
+                if res is None:
+                    # Copies of the question that are in flight share the answers of the first one, also across threads
+                    res = await answer_async(question, params)
+                return func.HttpResponse(add_timings(res, trace, timings), mimetype='application/json')
+            else:
+                return func.HttpResponse(
+                     "This HTTP triggered function executed successfully. Pass a question in the query string or in the request body for a personalized response.",
+                     status_code=200
+                )
+        except batcher.Overloaded as e:
+            # Shed load early instead of queuing, the client may retry shortly
+            logging.warning(f'[INFO] - Rejected request: {e}')
+            return func.HttpResponse("The reader is busy, please retry.", status_code=503, headers={'Retry-After': '1'})
@@ -0,0 +1,118 @@
+import os
+import logging
+import torch
+
+def get_model_size(model):
+    ''' Bytes of the weights of a model, incl. the packed weights of dynamically quantized layers '''
+    size = sum(p.numel() * p.element_size() for p in model.parameters())
+    for module in model.modules():
+        weight = getattr(module, 'weight', None)
+        if callable(weight):
+            size += weight().numel() * weight().element_size()
+    return size
+
+class PyTorchBackend:
+    """
+    Runs the reader with the PyTorch model as it is, fp32.
+
+    Parameters
+    ----------
+    model : transformers.PreTrainedModel
+        Question answering model.
+
+    device : torch.device
+        Device to run the model on.
+    """
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.model.to(device)
+        self.model.eval()
+        self.size = get_model_size(model)
+
+    def __call__(self, input_ids, attention_mask):
+        ''' Single forward pass of the reader on a padded batch, returns start and end logits '''
+        with torch.no_grad():
+            inputs = {
+                "input_ids": input_ids.to(self.device),
+                "attention_mask": attention_mask.to(self.device),
+                #"token_type_ids": batch[2], #TODO: had to comment this?
+            }
+            start_logits, end_logits = self.model(**inputs)[:2]
+        return start_logits.cpu(), end_logits.cpu()
+
+class QuantizedBackend(PyTorchBackend):
+    """
+    Runs the reader with the linear layers of the model dynamically quantized
+    to int8, on CPU.
+
+    Parameters
+    ----------
+    model : transformers.PreTrainedModel
+        Question answering model in fp32, quantized on load.
+    """
+
+    def __init__(self, model):
+        model = torch.quantization.quantize_dynamic(model.to('cpu'), {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(model, torch.device('cpu'))
+
+class OnnxBackend:
+    """
+    Runs the reader as exported ONNX model with onnxruntime on CPU, see
+    `export.py` to create the model.
+
+    Parameters
+    ----------
+    path : str
+        Path of the `.onnx` model.
+
+    num_threads : int, default None
+        Intra-op threads of onnxruntime, its default if None.
+    """
+
+    def __init__(self, path, num_threads=None):
+        # onnxruntime is an optional dependency, only imported once this backend is chosen
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError('The onnx backend requires onnxruntime, install it with `pip install -r requirements-onnx.txt`.') from e
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.size = os.path.getsize(path)
+
+    def __call__(self, input_ids, attention_mask):
+        ''' Single forward pass of the reader on a padded batch, returns start and end logits '''
+        start_logits, end_logits = self.session.run(
+            ['start_logits', 'end_logits'],
+            {'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()}
+        )
+        return torch.from_numpy(start_logits), torch.from_numpy(end_logits)
+
+backends = ['pytorch', 'quantized', 'onnx', 'pool']
+
+def load_backend(backend, model_class, config, model_name_or_path, device, onnx_path=None, num_threads=None, weights_path=None, processes=None, threads_per_process=1):
+    '''
+    Load the reader backend chosen in the configuration, one of `backends`
+    '''
+    if backend == 'onnx':
+        # The ONNX model replaces the PyTorch model, so the latter is never loaded
+        logging.warning(f'[INFO] - Loading ONNX reader from {onnx_path}.')
+        return OnnxBackend(onnx_path, num_threads=num_threads)
+    if backend == 'pool':
+        # Worker processes map the weights from one file, the PyTorch model is only loaded to export it once
+        from .workers import ReaderPool, export_weights
+        if not os.path.exists(weights_path + '.json'):
+            logging.warning(f'[INFO] - Exporting reader weights to {weights_path}.')
+            export_weights(model_class.from_pretrained(model_name_or_path, config=config), weights_path)
+        return ReaderPool(model_class, config, weights_path, processes=processes, threads=threads_per_process)
+    model = model_class.from_pretrained(model_name_or_path, config=config)
+    if backend == 'quantized':
+        logging.warning('[INFO] - Quantizing reader to int8.')
+        return QuantizedBackend(model)
+    elif backend != 'pytorch':
+        logging.error(f'Reader backend {backend} is not available, falling back to pytorch!')
+    return PyTorchBackend(model, device)
@@ -0,0 +1,107 @@
+'''
+Batch mode, answers many questions in one call.
+
+The searches of all questions run concurrently, identical questions are searched
+and read once, and the reader reads the (question, context) pairs of all questions
+in shared batches, see `reader.run_batch_prediction`.
+
+Run it on a JSONL file with one question per line, either as JSON string or as
+object with a `question`, and get one line of answers per question, in input order:
+    python -m MRC.batch questions.jsonl --output answers.jsonl
+'''
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ranker
+from . import retriever
+from . import reader
+from . import helper as he
+from . import telemetry
+
+def retrieve(question, n_doc, treshold, tokenize, bm_n_doc):
+    ''' Documents and sources of a question, ranked with BM25 (and the dense ranking, if enabled) like in `__init__.py` '''
+    documents, sources = retriever.main(question, n_doc, treshold, tokenize)
+    if documents and len(documents) > bm_n_doc:
+        documents, sources = ranker.main(question, documents, sources, bm_n_doc)
+    return documents, sources
+
+def answer_questions(questions, n_doc=5, treshold=5, tokenize=True, bm_n_doc=3, model=None, max_workers=None):
+    """
+    Answer many questions at once.
+
+    Parameters
+    ----------
+    questions : list[str]
+
+    n_doc, treshold, tokenize, bm_n_doc :
+        Parameters of the retriever and BM25, see `__init__.py`.
+
+    model : str, default None
+        Reader model, the default model if None.
+
+    max_workers : int, default None
+        Concurrent searches, `retrieval_workers` in the `[batch]` section of
+        the `config.ini` if None.
+
+    Returns
+    -------
+    results : list[dict]
+        Per question, in the order of the questions: the `question`, its
+        `answers` and their `counts`, like the response of a single question.
+    """
+    max_workers = max_workers or int(he.get_setting('batch', 'retrieval_workers', 8))
+    unique_questions = list(dict.fromkeys(questions))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mrc-batch') as pool:
+        retrieved = list(pool.map(telemetry.wrap(lambda question: retrieve(question, n_doc, treshold, tokenize, bm_n_doc)), unique_questions))
+    logging.warning(f'[INFO] - Retrieved documents of {len(unique_questions)} unique questions out of {len(questions)}.')
+
+    answers = reader.main_batch(
+        unique_questions,
+        [documents for documents, _ in retrieved],
+        [sources for _, sources in retrieved],
+        model
+    )
+    results = {
+        question: dict(
+            question = question,
+            answers = _answers,
+            counts = dict(
+                documents = len(documents),
+                answers = len(_answers)
+            )
+        )
+        for question, (documents, _), _answers in zip(unique_questions, retrieved, answers)
+    }
+    return [results[question] for question in questions]
+
+def read_questions(path):
+    ''' Questions of a JSONL file, one JSON string or object with a `question` per line '''
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            question = json.loads(line)
+            questions.append(question['question'] if isinstance(question, dict) else question)
+    return questions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer the questions of a JSONL file, one line of answers per question.')
+    parser.add_argument('questions', help='JSONL file with one question per line')
+    parser.add_argument('--output', default=None, help='JSONL file of the answers, printed if not given')
+    parser.add_argument('--az-documents', type=int, default=5)
+    parser.add_argument('--az-treshold', type=int, default=5)
+    parser.add_argument('--bm-ndoc', type=int, default=3)
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--chunk-size', type=int, default=64, help='questions answered per batch')
+    args = parser.parse_args()
+    questions = read_questions(args.questions)
+    out = open(args.output, 'w', encoding='utf-8') if args.output else None
+    for start in range(0, len(questions), args.chunk_size):
+        for result in answer_questions(questions[start:start + args.chunk_size], args.az_documents, args.az_treshold, True, args.bm_ndoc, args.model):
+            print(json.dumps(result, ensure_ascii=False), file=out, flush=out is None)
+        logging.warning(f'[INFO] - Answered {min(start + args.chunk_size, len(questions))} of {len(questions)} questions.')
+    if out is not None:
+        out.close()
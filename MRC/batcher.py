@@ -0,0 +1,184 @@
+import time
+import queue
+import logging
+import threading
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import telemetry
+
+def pad_batch(rows, pad_token_id=0):
+    ''' Pad unpadded input ids to the longest row, returns input ids and attention mask '''
+    input_ids = torch.full((len(rows), max(len(row) for row in rows)), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, row in enumerate(rows):
+        input_ids[i, :len(row)] = row
+        attention_mask[i, :len(row)] = 1
+    return input_ids, attention_mask
+
+class Overloaded(RuntimeError):
+    ''' Raised when a request would exceed the features the reader accepts at once '''
+
+class Closed(RuntimeError):
+    ''' Raised when features are submitted to a scheduler that was closed '''
+
+class BatchScheduler:
+    """
+    Micro-batching of reader forward passes across concurrent requests.
+
+    Requests hand in their features from their own threads. A single worker
+    thread groups the features into buckets of similar length and runs one
+    padded forward pass per bucket, as soon as the bucket is full or its
+    oldest feature waited for `max_latency` seconds.
+
+    Parameters
+    ----------
+    forward : callable
+        Called as `forward(input_ids, attention_mask)` with padded
+        `[batch, seq_len]` tensors, returns `(start_logits, end_logits)`.
+
+    pad_token_id : int, default 0
+        Token id used to pad the sequences of a batch.
+
+    max_batch_size : int, default 16
+        Maximum number of features per forward pass.
+
+    max_latency : float, default 0.01
+        Seconds a feature may wait for other features to join its batch.
+
+    bucket_width : int, default 32
+        Features whose lengths fall into the same multiple of `bucket_width`
+        are batched together, to keep the padding small.
+
+    max_concurrency : int, default 1
+        Batches run at once, e.g. one per process of a worker pool. While
+        all of them run, further features keep collecting into buckets.
+
+    max_pending : int, default None
+        Features submitted but not done yet that are accepted at once, a
+        request that would exceed them fails right away with `Overloaded`.
+        A request is always accepted while nothing is pending, even if it
+        has more features on its own.
+        No limit if None.
+    """
+
+    def __init__(self, forward, pad_token_id=0, max_batch_size=16, max_latency=0.01, bucket_width=32, max_concurrency=1, max_pending=None):
+        self.forward = forward
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.bucket_width = bucket_width
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='mrc-batch') if max_concurrency > 1 else None
+
+    def submit(self, rows):
+        """
+        Compute the logits of the given features, blocks until all of them are done.
+
+        Parameters
+        ----------
+        rows : list[torch.Tensor]
+            Unpadded input ids per feature.
+
+        Returns
+        -------
+        logits : list[tuple[torch.Tensor, torch.Tensor]]
+            Start and end logits per feature, as long as the feature.
+        """
+        with self._lock:
+            if self._closed:
+                raise Closed('Reader batch scheduler is closed.')
+            # An idle reader takes any request, so requests with more features than max_pending are still read
+            if self.max_pending is not None and self._pending and self._pending + len(rows) > self.max_pending:
+                raise Overloaded(f'Reader has {self._pending} pending features, {len(rows)} more exceed {self.max_pending}.')
+            self._pending += len(rows)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mrc-batch-scheduler', daemon=True)
+                self._thread.start()
+            # Queued under the lock, so all features are ahead of the stop signal of `close`
+            # The worker thread records the batches into the trace of the request
+            trace = telemetry.current()
+            futures = []
+            for row in rows:
+                future = Future()
+                self._queue.put((time.monotonic(), row, future, trace))
+                futures.append(future)
+        try:
+            return [future.result() for future in futures]
+        finally:
+            with self._lock:
+                self._pending -= len(rows)
+
+    def close(self):
+        ''' Stop the worker thread once the features already submitted are done, a later submit fails with `Closed` '''
+        with self._lock:
+            self._closed = True
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread = None
+
+    def _run(self):
+        buckets = {}
+        closed = False
+        while not closed or buckets:
+            # Sleep until a new feature arrives or the oldest bucket is due
+            deadlines = [items[0][0] + self.max_latency for items in buckets.values()]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                item = self._queue.get(timeout=timeout) if not closed else None
+                while item is not None:
+                    buckets.setdefault(-(-len(item[1]) // self.bucket_width), []).append(item)
+                    item = self._queue.get_nowait()
+                closed = True
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for bucket in list(buckets):
+                items = buckets[bucket]
+                while items and (closed or len(items) >= self.max_batch_size or now - items[0][0] >= self.max_latency):
+                    batch, items = items[:self.max_batch_size], items[self.max_batch_size:]
+                    if self._executor is None:
+                        self._run_batch(batch)
+                    else:
+                        # Blocks while all slots are busy, new features keep queuing for the next batches meanwhile
+                        self._slots.acquire()
+                        self._executor.submit(self._run_slot, batch)
+                if items:
+                    buckets[bucket] = items
+                else:
+                    del buckets[bucket]
+
+    def _run_slot(self, batch):
+        try:
+            self._run_batch(batch)
+        finally:
+            self._slots.release()
+
+    def _run_batch(self, batch):
+        lengths = [len(row) for _, row, _, _ in batch]
+        input_ids, attention_mask = pad_batch([row for _, row, _, _ in batch], self.pad_token_id)
+        start = time.time_ns()
+        try:
+            start_logits, end_logits = self.forward(input_ids, attention_mask)
+        except Exception as e:
+            logging.error(f'Reader batch of {len(batch)} features failed: {e}')
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+        end = time.time_ns()
+        logging.info(f'Ran reader batch of {len(batch)} features, padded to {max(lengths)} tokens.')
+        # A batch may hold the features of several requests, each of them gets the whole forward pass
+        traces = {id(trace): trace for _, _, _, trace in batch if trace is not None}
+        for trace in traces.values():
+            trace.add_span('reader.model', start, end)
+            trace.observe('reader.batch_size', len(batch))
+            trace.observe('reader.padded_tokens', max(lengths))
+        for i, (_, _, future, _) in enumerate(batch):
+            future.set_result((start_logits[i, :lengths[i]], end_logits[i, :lengths[i]]))
@@ -1,8 +1,98 @@
+import os
 import math
+import json
+import atexit
+import time
+import hashlib
+import shutil
 import logging
+import threading
+import numpy as np
+from itertools import filterfalse
+from collections import OrderedDict, defaultdict
+from . import helper as he
 
 stopwords = set(["i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your", "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "her", "hers", "herself", "it", "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who", "whom", "this", "that", "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an", "the", "and", "but", "if", "or", "because", "as", "until", "while", "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during", "before", "after", "above", "below", "to", "from", "up", "down", "in", "out", "on", "off", "over", "under", "again", "further", "then", "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few", "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s", "t", "can", "will", "just", "don", "should", "now"])
 
+class TextNormalizer:
+    """
+    Tokenizer for BM25, shared by the query and the corpus of a request.
+
+    Texts are lowercased and split on whitespace, stopwords are dropped and
+    the terms are mapped to vocabulary ids, all in one pass per text. Every
+    distinct term is stored once in the vocabulary, the texts are arrays of
+    its ids.
+
+    Parameters
+    ----------
+    stopwords : set[str], default `stopwords`
+        Terms to drop.
+
+    Attributes
+    ----------
+    vocabulary_ : dict[str, int]
+        Term to vocabulary id.
+
+    terms_ : list[str]
+        Term per vocabulary id.
+    """
+
+    def __init__(self, stopwords=stopwords):
+        self.stopwords = frozenset(stopwords)
+        # A missing term gets the next id on lookup, so the lookups run without a Python loop
+        self.vocabulary_ = defaultdict()
+        self.vocabulary_.default_factory = self.vocabulary_.__len__
+        self._terms = []
+
+    @property
+    def terms_(self):
+        if len(self._terms) < len(self.vocabulary_):
+            # Dicts keep the insertion order, which is the order of the ids
+            self._terms = list(self.vocabulary_)
+        return self._terms
+
+    def transform(self, text):
+        """
+        Vocabulary ids of the terms of a text, new terms are added to the
+        vocabulary.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        term_ids : np.ndarray[int64]
+        """
+        terms = filterfalse(self.stopwords.__contains__, text.lower().split())
+        return np.fromiter(map(self.vocabulary_.__getitem__, terms), dtype=np.int64)
+
+    def filter_rare(self, documents, min_count=2):
+        """
+        Drop the terms that appear less than `min_count` times in all
+        documents together, counted with one `np.bincount`.
+
+        Parameters
+        ----------
+        documents : list[np.ndarray[int64]]
+            Vocabulary ids per document.
+
+        min_count : int, default 2
+
+        Returns
+        -------
+        documents : list[np.ndarray[int64]]
+        """
+        if not documents:
+            return []
+        keep = np.bincount(np.concatenate(documents), minlength=len(self.vocabulary_)) >= min_count
+        return [term_ids[keep[term_ids]] for term_ids in documents]
+
+    def get_terms(self, term_ids):
+        ''' Terms of the given vocabulary ids '''
+        terms = self.terms_
+        return [terms[term_id] for term_id in term_ids.tolist()]
+
 class BM25:
     """
     Best Match 25.
@@ -113,38 +203,477 @@ class BM25:
 
         return score
 
-def preprocess_text(corpus):
-    ''' Prepare text for BM25-compatibility '''
-    texts = [
-        [word for word in document.lower().split() if word not in stopwords]
-        for document in corpus
-    ]
+class CorpusStatistics:
+    """
+    Corpus statistics for BM25 that outlive a single request.
 
-    # Build a word count dictionary so we can remove words that appear only once
-    word_count_dict = {}
-    for text in texts:
-        for token in text:
-            word_count = word_count_dict.get(token, 0) + 1
-            word_count_dict[token] = word_count
+    Documents are added and removed one at a time, so document frequencies
+    and the average document length describe every document seen by the
+    worker so far, instead of only the few snippets of one search.
 
-    texts = [[token for token in text if word_count_dict[token] > 1] for text in texts]
-    return texts
+    Parameters
+    ----------
+    max_documents : int, default None
+        Maximum number of documents to keep, the oldest documents are
+        removed first. No limit if None.
 
-def main(query, corpus, sources, bm_n_doc):
-    logging.warning('Applying BM25 algorithm ...')
+    Attributes
+    ----------
+    vocabulary_ : dict[str, int]
+        Term to vocabulary id, terms of no document are dropped and their
+        ids are reused.
+
+    terms_ : list[str]
+        Term per vocabulary id, None for the ids of dropped terms.
+
+    df_ : np.ndarray[int64]
+        Document Frequency per term id.
+
+    documents_ : OrderedDict[str, tuple[np.ndarray, int]]
+        Unique term ids and number of terms per document key, in insertion
+        order.
+
+    corpus_size_ : int
+        Number of documents in the statistics.
+
+    avg_doc_len_ : float
+        Average number of terms for documents in the statistics.
+    """
+
+    def __init__(self, max_documents=None):
+        self.max_documents = max_documents
+        self.vocabulary_ = {}
+        self.terms_ = []
+        self.df_ = np.zeros(1024, dtype=np.int64)
+        self._free_ids = []
+        self.documents_ = OrderedDict()
+        self.total_len_ = 0
+        self._lock = threading.Lock()
+
+    @property
+    def corpus_size_(self):
+        return len(self.documents_)
+
+    @property
+    def avg_doc_len_(self):
+        return self.total_len_ / self.corpus_size_ if self.corpus_size_ else 0.0
+
+    def add(self, key, document):
+        """
+        Add a document to the statistics.
+
+        Parameters
+        ----------
+        key : str
+            Unique key of the document, see `document_key`.
+
+        document : list[str]
+            Terms of the document.
+
+        Returns
+        -------
+        added : bool
+            False if the key was already known.
+        """
+        with self._lock:
+            if key in self.documents_:
+                return False
+            term_ids = []
+            for term in set(document):
+                term_id = self.vocabulary_.get(term)
+                if term_id is None:
+                    if self._free_ids:
+                        term_id = self._free_ids.pop()
+                        self.terms_[term_id] = term
+                    else:
+                        term_id = len(self.terms_)
+                        self.terms_.append(term)
+                    self.vocabulary_[term] = term_id
+                term_ids.append(term_id)
+            if len(self.terms_) > len(self.df_):
+                # Grow geometrically, also turns a memory-mapped array into a private copy
+                df = np.zeros(max(len(self.terms_), 2 * len(self.df_)), dtype=np.int64)
+                df[:len(self.df_)] = self.df_
+                self.df_ = df
+            term_ids = np.asarray(term_ids, dtype=np.int64)
+            self.df_[term_ids] += 1
+            self.documents_[key] = (term_ids, len(document))
+            self.total_len_ += len(document)
+            if self.max_documents and len(self.documents_) > self.max_documents:
+                self._remove(next(iter(self.documents_)))
+            return True
+
+    def remove(self, key):
+        """
+        Remove a document from the statistics.
+
+        Parameters
+        ----------
+        key : str
+            Unique key of the document, see `document_key`.
+
+        Returns
+        -------
+        removed : bool
+            False if the key was not known.
+        """
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        if key not in self.documents_:
+            return False
+        term_ids, doc_len = self.documents_.pop(key)
+        self.df_[term_ids] -= 1
+        self.total_len_ -= doc_len
+        # Terms of no document are dropped, so the vocabulary stays as large as the documents kept
+        for term_id in np.asarray(term_ids)[self.df_[term_ids] == 0].tolist():
+            del self.vocabulary_[self.terms_[term_id]]
+            self.terms_[term_id] = None
+            self._free_ids.append(term_id)
+        return True
+
+    def idf(self, terms):
+        """
+        Inverse Document Frequency of the given terms, unknown terms have a
+        document frequency of zero.
+
+        Parameters
+        ----------
+        terms : list[str]
+
+        Returns
+        -------
+        idf : np.ndarray[float64]
+        """
+        with self._lock:
+            corpus_size = self.corpus_size_
+            df = [int(self.df_[self.vocabulary_[term]]) if term in self.vocabulary_ else 0 for term in terms]
+        return np.array([math.log(1 + (corpus_size - freq + 0.5) / (freq + 0.5)) for freq in df], dtype=np.float64)
+
+    def save(self, path):
+        """
+        Save the statistics as a folder of `.npy` arrays, that can be
+        memory-mapped by `load`.
+
+        Every save writes a new version folder inside `path` and then
+        points `path/CURRENT` to it with an atomic rename, so the files of
+        a version are never written while they are mapped, and processes
+        that save to the same path at once never mix their files. The last
+        saved version wins, older versions are removed.
+
+        Parameters
+        ----------
+        path : str
+            Folder to write to, created if missing.
+        """
+        version = f'v{time.time_ns()}-{os.getpid()}-{threading.get_ident()}'
+        folder = os.path.join(path, version)
+        with self._lock:
+            os.makedirs(folder)
+            keys = list(self.documents_.keys())
+            doc_terms = [term_ids for term_ids, _ in self.documents_.values()]
+            doc_len = [doc_len for _, doc_len in self.documents_.values()]
+            indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+            np.cumsum([len(term_ids) for term_ids in doc_terms], out=indptr[1:])
+            # Copied out of the memory-mapped arrays of `load`
+            np.save(os.path.join(folder, 'df.npy'), np.array(self.df_[:len(self.terms_)]))
+            np.save(os.path.join(folder, 'doc_indptr.npy'), indptr)
+            np.save(os.path.join(folder, 'doc_terms.npy'), np.concatenate(doc_terms) if doc_terms else np.zeros(0, dtype=np.int64))
+            np.save(os.path.join(folder, 'doc_len.npy'), np.asarray(doc_len, dtype=np.int64))
+            with open(os.path.join(folder, 'index.json'), 'w', encoding='utf-8') as f:
+                json.dump(dict(vocabulary=self.terms_, keys=keys), f)
+        current = os.path.join(path, 'CURRENT')
+        with open(f'{current}.{version}.tmp', 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(f'{current}.{version}.tmp', current)
+        # Mapped files of removed versions stay valid for the processes that mapped them, where the platform allows it
+        for name in os.listdir(path):
+            if name.startswith('v') and name != version and os.path.isdir(os.path.join(path, name)) and name < version:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        logging.info(f'Saved BM25 statistics of {len(keys)} documents to {folder}.')
+
+    @staticmethod
+    def find(path):
+        ''' Folder of the current version saved to path by `save`, None if there is none '''
+        current = os.path.join(path, 'CURRENT')
+        if os.path.exists(current):
+            with open(current, encoding='utf-8') as f:
+                return os.path.join(path, f.read().strip())
+        # Folders saved before there were versions
+        if os.path.exists(os.path.join(path, 'index.json')):
+            return path
+        return None
+
+    @classmethod
+    def load(cls, path, max_documents=None):
+        """
+        Load statistics saved by `save`. The arrays are memory-mapped copy-on-write,
+        so nothing is read until it is used and the file is never modified.
+
+        Parameters
+        ----------
+        path : str
+            Folder written by `save`, its current version is loaded.
+
+        max_documents : int, default None
+            See `CorpusStatistics`.
+
+        Returns
+        -------
+        statistics : CorpusStatistics
+        """
+        path = cls.find(path) or path
+        with open(os.path.join(path, 'index.json'), encoding='utf-8') as f:
+            index = json.load(f)
+        indptr = np.load(os.path.join(path, 'doc_indptr.npy'))
+        doc_terms = np.load(os.path.join(path, 'doc_terms.npy'), mmap_mode='r')
+        doc_len = np.load(os.path.join(path, 'doc_len.npy'))
+
+        statistics = cls(max_documents=max_documents)
+        statistics.terms_ = index['vocabulary']
+        statistics.vocabulary_ = {term: term_id for term_id, term in enumerate(statistics.terms_) if term is not None}
+        statistics._free_ids = [term_id for term_id, term in enumerate(statistics.terms_) if term is None]
+        statistics.df_ = np.load(os.path.join(path, 'df.npy'), mmap_mode='c')
+        for i, key in enumerate(index['keys']):
+            statistics.documents_[key] = (doc_terms[indptr[i]:indptr[i + 1]], int(doc_len[i]))
+        statistics.total_len_ = int(doc_len.sum())
+        logging.info(f'Loaded BM25 statistics of {statistics.corpus_size_} documents from {path}.')
+        return statistics
+
+def document_key(document):
+    ''' Key of a raw document text in the `CorpusStatistics` '''
+    return hashlib.sha1(document.encode('utf-8')).hexdigest()
+
+class InvertedIndexBM25:
+    """
+    Best Match 25 on an inverted index.
+
+    Produces the same scores as `BM25`, but stores the corpus as term ->
+    postings lists in CSR layout, so a query is scored in a single
+    vectorized pass over the postings of its terms instead of once per
+    document.
+
+    Parameters
+    ----------
+    k1 : float, default 1.5
+
+    b : float, default 0.75
+
+    Attributes
+    ----------
+    vocabulary_ : dict[str, int]
+        Term to vocabulary id.
+
+    indptr_ : np.ndarray[int64]
+        Postings of term id `t` are stored in
+        `doc_ids_[indptr_[t]:indptr_[t + 1]]`.
+
+    doc_ids_ : np.ndarray[int64]
+        Document ids of all postings, grouped by term id.
+
+    tf_ : np.ndarray[float64]
+        Term frequency of every posting, aligned with `doc_ids_`.
+
+    idf_ : np.ndarray[float64]
+        Inverse Document Frequency per term id.
+
+    doc_len_ : np.ndarray[float64]
+        Number of terms per document.
+
+    corpus_size_ : int
+        Number of documents in the corpus.
+
+    avg_doc_len_ : float
+        Average number of terms for documents in the corpus.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.b = b
+        self.k1 = k1
+
+    def fit(self, corpus, statistics=None, normalizer=None, doc_len=None):
+        """
+        Build the inverted index and the statistics that are required to
+        calculate BM25 ranking score using the corpus given.
+
+        Parameters
+        ----------
+        corpus : list[list[str]]
+            Each element in the list represents a document, and each document
+            is a list of the terms. If a normalizer is given, each document
+            is an array of its vocabulary ids instead.
+
+        statistics : CorpusStatistics, default None
+            Take idf and average document length from these statistics
+            instead of the corpus. The documents of the corpus should have
+            been added to it.
+
+        normalizer : TextNormalizer, default None
+            Normalizer whose vocabulary ids the documents are made of, its
+            vocabulary is shared by the index.
+
+        doc_len : list[int], default None
+            Number of terms per document to normalize the scores with, the
+            lengths of the documents of the corpus if None. With statistics,
+            they have to be counted like the documents of the statistics,
+            e.g. before rare terms were dropped from the corpus.
+
+        Returns
+        -------
+        self
+        """
+        if normalizer is None:
+            normalizer = TextNormalizer(stopwords=())
+            corpus = [np.fromiter(map(normalizer.vocabulary_.__getitem__, document), dtype=np.int64) for document in corpus]
+        vocabulary = normalizer.vocabulary_
+        corpus_size = len(corpus)
+        lengths = np.asarray([len(document) for document in corpus], dtype=np.int64)
+        doc_len = lengths if doc_len is None else np.asarray(doc_len, dtype=np.int64)
+
+        # compute tf (term frequency) of every (term id, document) pair, sorted by term id and document
+        term_ids = np.concatenate(corpus) if corpus_size else np.zeros(0, dtype=np.int64)
+        pairs, tf = np.unique(term_ids * corpus_size + np.repeat(np.arange(corpus_size), lengths), return_counts=True)
+        df = np.bincount(pairs // max(corpus_size, 1), minlength=len(vocabulary))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+
+        if statistics is not None and statistics.corpus_size_:
+            idf = statistics.idf(normalizer.terms_)
+            avg_doc_len = statistics.avg_doc_len_
+        else:
+            # math.log keeps the idf bit-identical to `BM25`, it is only computed once per distinct df
+            values, inverse = np.unique(df, return_inverse=True)
+            idf = np.array([math.log(1 + (corpus_size - freq + 0.5) / (freq + 0.5)) for freq in values.tolist()], dtype=np.float64)[inverse]
+            avg_doc_len = int(doc_len.sum()) / corpus_size
+
+        self.vocabulary_ = vocabulary
+        self.indptr_ = indptr
+        self.doc_ids_ = pairs % max(corpus_size, 1)
+        self.tf_ = tf.astype(np.float64)
+        self.idf_ = idf
+        self.doc_len_ = doc_len.astype(np.float64)
+        self.corpus_size_ = corpus_size
+        self.avg_doc_len_ = avg_doc_len
+        return self
+
+    def search(self, query):
+        """
+        Score every document of the corpus against the query.
+
+        Parameters
+        ----------
+        query : list[str]
+            Terms of the query, terms outside the vocabulary are ignored.
+
+        Returns
+        -------
+        scores : np.ndarray[float64]
+            BM25 score per document.
+        """
+        return self.search_ids(np.asarray([self.vocabulary_[term] for term in query if term in self.vocabulary_], dtype=np.int64))
+
+    def search_ids(self, query_ids):
+        """
+        Score every document of the corpus against a query of vocabulary ids,
+        e.g. from the same `TextNormalizer` as the corpus.
+
+        Parameters
+        ----------
+        query_ids : np.ndarray[int64]
+
+        Returns
+        -------
+        scores : np.ndarray[float64]
+            BM25 score per document.
+        """
+        # Ids of terms that were added to the vocabulary after fit have no postings
+        query_ids = query_ids[query_ids < len(self.indptr_) - 1]
+        if not len(query_ids):
+            return np.zeros(self.corpus_size_, dtype=np.float64)
+
+        # Gather the postings of all query terms, in query order
+        starts = self.indptr_[query_ids]
+        lengths = self.indptr_[query_ids + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        doc_ids = self.doc_ids_[positions]
+        freq = self.tf_[positions]
+        idf = np.repeat(self.idf_[query_ids], lengths)
+
+        # Same operation order as `BM25._score` to get identical floats
+        numerator = idf * freq * (self.k1 + 1)
+        denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len_[doc_ids] / self.avg_doc_len_)
+        return np.bincount(doc_ids, weights=numerator / denominator, minlength=self.corpus_size_)
+
+def top_k(scores, k):
+    ''' Indices of the k highest scores, ties keep their original order like a stable sort '''
+    scores = np.asarray(scores, dtype=np.float64)
+    if 0 < k < len(scores):
+        # Only the k-th largest score is needed to bound the candidates
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return ranked[:k]
+
+def preprocess_text(corpus, normalizer=None):
+    ''' Prepare text for BM25-compatibility, returns the vocabulary ids per document if a normalizer is given, the terms otherwise '''
+    if normalizer is not None:
+        # Drop the words that appear only once
+        return normalizer.filter_rare([normalizer.transform(document) for document in corpus])
+    normalizer = TextNormalizer()
+    return [normalizer.get_terms(term_ids) for term_ids in preprocess_text(corpus, normalizer)]
+
+# Statistics are kept at module scope, so they stay warm across requests of a worker
+if str(he.get_setting('bm25', 'global_statistics', 'true')).lower() == 'true':
+    stats_path = he.get_setting('bm25', 'stats_path')
+    max_documents = int(he.get_setting('bm25', 'max_documents', 100000))
+    corpus_statistics = None
+    if stats_path and CorpusStatistics.find(stats_path):
+        try:
+            corpus_statistics = CorpusStatistics.load(stats_path, max_documents=max_documents)
+        except (OSError, ValueError) as e:
+            # Damaged statistics must not keep the worker from starting, they are built again
+            logging.warning(f'[INFO] - Could not load the BM25 statistics from {stats_path}: {e}')
+    if corpus_statistics is None:
+        corpus_statistics = CorpusStatistics(max_documents=max_documents)
+    if stats_path:
+        atexit.register(corpus_statistics.save, stats_path)
+else:
+    corpus_statistics = None
+
+def score(query, corpus):
+    ''' BM25 score of every document of the corpus for the query '''
+    # Query and corpus share one normalizer, so every token is processed once
+    normalizer = TextNormalizer()
     # Query our corpus to see which document is more relevant
-    query = [word for word in query.lower().split() if word not in stopwords]
+    query = normalizer.transform(query)
     # Preprocess text to remove stopwords and stuff
-    texts = preprocess_text(corpus)
+    documents = [normalizer.transform(document) for document in corpus]
+    # Update the worker-wide statistics with documents not seen before, with all their terms
+    if corpus_statistics is not None:
+        for document, term_ids in zip(corpus, documents):
+            key = document_key(document)
+            if key not in corpus_statistics.documents_:
+                corpus_statistics.add(key, normalizer.get_terms(term_ids))
+    # Drop the words that appear only once in this request, for scoring only
+    texts = normalizer.filter_rare(documents)
     # Fit and score texts on BM25
-    bm25 = BM25()
-    bm25.fit(texts)
-    scores = bm25.search(query)
-    # Sort by relevance score
-    bm25_ranked = sorted(zip(scores, corpus, sources), key = lambda x: x[0], reverse=True)
-    # Unpack the zipped lists
-    scores, corpus, sources = zip(*bm25_ranked[:bm_n_doc])
-    return list(corpus), list(sources)
+    bm25 = InvertedIndexBM25()
+    if corpus_statistics is not None:
+        # Lengths are counted with all terms, like the average length of the statistics
+        bm25.fit(texts, statistics=corpus_statistics, normalizer=normalizer, doc_len=[len(term_ids) for term_ids in documents])
+    else:
+        bm25.fit(texts, normalizer=normalizer)
+    return bm25.search_ids(query)
+
+def main(query, corpus, sources, bm_n_doc):
+    logging.warning('Applying BM25 algorithm ...')
+    scores = score(query, corpus)
+    # Select the most relevant documents, without sorting the whole corpus
+    ranked = top_k(scores, bm_n_doc)
+    return [corpus[i] for i in ranked], [sources[i] for i in ranked]
 
 if __name__ ==  '__main__':
     # Test question + context
@@ -161,23 +690,7 @@ if __name__ ==  '__main__':
     ]
     sources = [
         {'metadata_storage_name': 'bla',
-        'document_id': 'bla',
-        'document_uri': 'bla',
-        'title': 'bla'},
-        {'metadata_storage_name': 'bla',
-        'document_id': 'bla',
-        'document_uri': 'bla',
-        'title': 'bla'},
-        {'metadata_storage_name': 'bla',
-        'document_id': 'bla',
-        'document_uri': 'bla',
-        'title': 'bla'},
-        {'metadata_storage_name': 'bla',
-        'document_id': 'bla',
-        'document_uri': 'bla',
-        'title': 'bla'},
-        {'metadata_storage_name': 'bla',
-        'document_id': 'bla',
+        'document_id': str(i),
         'document_uri': 'bla',
-        'title': 'bla'}]
-    main("The intersection of graph survey and trees", corpus, sources)
\ No newline at end of file
+        'title': 'bla'} for i in range(len(corpus))]
+    print(main("The intersection of graph survey and trees", corpus, sources, 3))
\ No newline at end of file
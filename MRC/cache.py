@@ -0,0 +1,178 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from . import helper as he
+
+class LRUCache:
+    """
+    In-memory cache, least recently used entries are dropped first.
+
+    Parameters
+    ----------
+    max_entries : int, default 10000
+        Maximum number of entries.
+
+    Attributes
+    ----------
+    hits_ : int
+        Number of lookups that found a valid entry.
+
+    misses_ : int
+        Number of lookups that did not.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits_ = 0
+        self.misses_ = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Value of the key, None if missing or expired '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                self._entries.pop(key, None)
+                self.misses_ += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits_ += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ''' Store a value, it expires after ttl seconds if given '''
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SQLiteCache:
+    """
+    Cache in a SQLite file, that can be shared by the workers of a host.
+    Values have to be JSON serializable. Stands in for a shared cache
+    service, which only needs the same `get` and `set` methods.
+
+    Parameters
+    ----------
+    path : str
+        Path of the database file, created if missing.
+
+    Attributes
+    ----------
+    hits_ : int
+        Number of lookups that found a valid entry.
+
+    misses_ : int
+        Number of lookups that did not.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits_ = 0
+        self.misses_ = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def get(self, key):
+        ''' Value of the key, None if missing or expired '''
+        with self._lock:
+            row = self._connection.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                self.misses_ += 1
+                return None
+            self.hits_ += 1
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ''' Store a value, it expires after ttl seconds if given '''
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time() + ttl if ttl else None)
+            )
+
+class TieredCache:
+    """
+    In-memory LRU cache in front of an optional shared cache. Hits of the
+    shared cache are copied to the in-memory cache.
+
+    Parameters
+    ----------
+    local : LRUCache
+
+    shared : SQLiteCache, default None
+        Or any object with the same `get` and `set` methods.
+
+    ttl : float, default None
+        Seconds until entries expire, never if None.
+    """
+
+    def __init__(self, local, shared=None, ttl=None):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, self.ttl)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value, self.ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, self.ttl)
+
+    def stats(self):
+        ''' Hit and miss counters per tier '''
+        stats = dict(local = dict(hits = self.local.hits_, misses = self.local.misses_))
+        if self.shared is not None:
+            stats['shared'] = dict(hits = self.shared.hits_, misses = self.shared.misses_)
+        return stats
+
+def normalize_question(question):
+    ''' Fold the case and the whitespace of the question, so only these variants share entries, punctuation is kept: "C++" and "C#" are different questions '''
+    return " ".join(question.casefold().split())
+
+def get_key(*parts):
+    ''' Cache key from the given parts '''
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def answer_key(question, *params):
+    ''' Key of the final answers to a question, with the parameters of the request '''
+    return 'answers:' + get_key(normalize_question(question), *params)
+
+def span_key(question, context, model_name):
+    ''' Key of the answer span of the reader for the question as the reader got it and a retrieved context '''
+    return 'span:' + get_key(question, hashlib.sha1(context.encode('utf-8')).hexdigest(), model_name)
+
+# Caches are kept at module scope, so they stay warm across requests of a worker
+if str(he.get_setting('cache', 'enabled', 'true')).lower() == 'true':
+    max_entries = int(he.get_setting('cache', 'max_entries', 10000))
+    shared_path = he.get_setting('cache', 'shared_path')
+    # (a) question -> final answers
+    answers = TieredCache(
+        LRUCache(max_entries),
+        SQLiteCache(shared_path) if shared_path else None,
+        ttl=float(he.get_setting('cache', 'answer_ttl', 3600))
+    )
+    # (b) (question, context) -> span prediction of the reader
+    spans = TieredCache(
+        LRUCache(max_entries),
+        SQLiteCache(shared_path) if shared_path else None,
+        ttl=float(he.get_setting('cache', 'span_ttl', 86400))
+    )
+    logging.info(f'Answer cache enabled, shared cache: {shared_path}.')
+else:
+    answers = None
+    spans = None
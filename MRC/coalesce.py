@@ -0,0 +1,86 @@
+'''
+Coalescing of identical requests that are in flight at the same time (single flight).
+
+During a spike, the same question arrives many times before the first copy is answered,
+and before the answer cache can help. The first copy of a question computes the response,
+the copies that arrive meanwhile wait for it and share its response or its error. Threads
+and coroutines share the same calls, so copies of the sync and the async entry point are
+coalesced with each other as well.
+'''
+import asyncio
+import threading
+from concurrent.futures import Future
+from . import telemetry
+
+class SingleFlight:
+    """
+    Calls in flight per key, to share the result of the first call with
+    concurrent calls of the same key.
+
+    Attributes
+    ----------
+    calls_ : int
+        Calls that computed their result.
+
+    coalesced_ : int
+        Calls that waited for the result of another call instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+        self.calls_ = 0
+        self.coalesced_ = 0
+
+    def _join(self, key):
+        ''' Future of the call in flight for the key, and whether this call has to compute it '''
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced_ += 1
+                telemetry.count('coalesce.waited')
+                return future, False
+            future = self._futures[key] = Future()
+            self.calls_ += 1
+            return future, True
+
+    def _leave(self, key):
+        with self._lock:
+            del self._futures[key]
+
+    def do(self, key, fn, *args):
+        ''' Result of fn(*args), or of the call of the same key in flight '''
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._leave(key)
+
+    async def do_async(self, key, fn, *args):
+        ''' Result of await fn(*args), or of the call of the same key in flight, also if that call runs in a thread '''
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._leave(key)
+
+    def stats(self):
+        ''' Computed and coalesced calls, and calls in flight '''
+        with self._lock:
+            return dict(calls = self.calls_, coalesced = self.coalesced_, in_flight = len(self._futures))
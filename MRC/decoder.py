@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+def pad_logits(logits):
+    ''' Stack unpadded logits of several features into one matrix, padded with -inf '''
+    padded = torch.full((len(logits), max(len(l) for l in logits)), -float('inf'), dtype=torch.float32)
+    for i, l in enumerate(logits):
+        padded[i, :len(l)] = l
+    return padded
+
+def get_span_masks(features, seq_len):
+    ''' Masks of the tokens that may start and end an answer, i.e. context tokens, starts also need the max context '''
+    positions = torch.arange(seq_len)[None, :]
+    context_offset = torch.tensor([feature.context_offset for feature in features])[:, None]
+    window_length = torch.tensor([len(feature.offsets) for feature in features])[:, None]
+    end_mask = (positions >= context_offset) & (positions < context_offset + window_length)
+    start_mask = end_mask.clone()
+    for i, feature in enumerate(features):
+        start_mask[i, feature.context_offset:feature.context_offset + len(feature.offsets)] &= torch.from_numpy(feature.max_context)
+    return start_mask, end_mask
+
+def get_best_spans(start_logits, end_logits, start_mask, end_mask, max_answer_length=50):
+    '''
+    Best valid span per feature, from the [features, start, length] band of span scores,
+    i.e. only the spans with end >= start and at most max_answer_length tokens are scored.
+    Returns start, end and score per feature, the score is -inf if there is no valid span.
+    '''
+    seq_len = start_logits.shape[1]
+    width = min(max_answer_length, seq_len)
+    # End token per start and length, ends past the sequence are masked
+    end = torch.arange(seq_len)[:, None] + torch.arange(width)[None, :]
+    inside = end < seq_len
+    end = end.clamp(max=seq_len - 1)
+    valid = inside[None, :, :] & start_mask[:, :, None] & end_mask[:, end]
+    scores = start_logits[:, :, None] + end_logits[:, end]
+    scores.masked_fill_(~valid, -float('inf'))
+    # Ties go to the first start and the shortest span, like on the full [start, end] matrix
+    best_score, best = scores.view(len(scores), -1).max(dim=1)
+    start = best // width
+    return start, start + best % width, best_score
+
+def decode_predictions(features, outputs, contexts, max_answer_length=50, null_score_diff_threshold=0.0, return_scores=False, return_starts=False):
+    '''
+    Pick the answer per context from the start and end logits of its features.
+    The best valid span over all windows of a context wins, unless the lowest null score
+    ([CLS] start and end) of the context is higher by more than the threshold (SQuAD 2.0).
+    Returns the answer text per context, empty if there is no answer. With return_scores,
+    the scores of the answers are returned as well, i.e. by how much the span score beats
+    the null score, as a confidence. With return_starts, the character offset of every
+    answer in its context is returned as well, -1 if there is no answer.
+    '''
+    def result(answers, scores, starts):
+        returned = (answers,) + ((scores,) if return_scores else ()) + ((starts,) if return_starts else ())
+        return returned if len(returned) > 1 else answers
+
+    if not features:
+        return result(["" for _ in contexts], [-float('inf') for _ in contexts], [-1 for _ in contexts])
+    start_logits = pad_logits([start for start, _ in outputs])
+    end_logits = pad_logits([end for _, end in outputs])
+    start_mask, end_mask = get_span_masks(features, start_logits.shape[1])
+    start_index, end_index, span_score = get_best_spans(start_logits, end_logits, start_mask, end_mask, max_answer_length)
+    null_score = (start_logits[:, 0] + end_logits[:, 0]).numpy()
+    start_index, end_index, span_score = start_index.numpy(), end_index.numpy(), span_score.numpy()
+
+    # Best feature and lowest null score per context
+    example_index = np.array([feature.example_index for feature in features])
+    order = np.lexsort((np.arange(len(features)), -span_score, example_index))
+    examples, first = np.unique(example_index[order], return_index=True)
+    best_feature = dict(zip(examples.tolist(), order[first].tolist()))
+    min_null_score = np.full(len(contexts), np.inf)
+    np.minimum.at(min_null_score, example_index, null_score)
+
+    answers = []
+    scores = []
+    starts = []
+    for i, context in enumerate(contexts):
+        f = best_feature.get(i)
+        if f is None or not np.isfinite(span_score[f]) or min_null_score[i] - span_score[f] > null_score_diff_threshold:
+            answers.append("")
+            scores.append(-float('inf') if f is None else float(span_score[f] - min_null_score[i]))
+            starts.append(-1)
+            continue
+        feature = features[f]
+        start_token, end_token = start_index[f] - feature.context_offset, end_index[f] - feature.context_offset
+        start_char, end_char = feature.offsets[start_token, 0], feature.offsets[end_token, 1]
+        if feature.subword[start_token]:
+            # Spans that start within a word are extended to the whole words, like the SQuAD processor did
+            while start_char > 0 and not context[start_char - 1].isspace():
+                start_char -= 1
+            while end_char < len(context) and not context[end_char].isspace():
+                end_char += 1
+        # Whitespace is collapsed like in the whitespace-tokenized text of the SQuAD processor
+        answers.append(" ".join(context[start_char:end_char].split()))
+        scores.append(float(span_score[f] - min_null_score[i]))
+        starts.append(int(start_char))
+    return result(answers, scores, starts)
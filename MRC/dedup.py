@@ -0,0 +1,113 @@
+'''
+Suppression of duplicate and near-duplicate snippets.
+
+Overlapping highlights of the same document, or mirrored documents, give snippets
+that differ in a few words only. Exact duplicates are found in a dict, near duplicates
+by MinHash signatures of hashed word shingles in LSH buckets. The first snippet, i.e.
+the one of the best search result, is kept and the metadata of its duplicates from
+other documents is merged into it as `sources`.
+'''
+import re
+import zlib
+import numpy as np
+
+# Mersenne prime of the universal hash functions of the signatures
+prime = (1 << 61) - 1
+
+class SnippetIndex:
+    """
+    Snippets seen so far, to tell new snippets from duplicates.
+
+    Parameters
+    ----------
+    threshold : float, default 0.8
+        Estimated Jaccard similarity of the shingles from which a snippet is
+        a near duplicate. 0 finds exact duplicates only.
+
+    num_perm : int, default 64
+        Hash functions of the MinHash signature.
+
+    bands : int, default 16
+        LSH bands, snippets that agree on all rows of a band are compared.
+        `num_perm` must be a multiple of `bands`.
+
+    shingle_size : int, default 3
+        Words per shingle.
+
+    seed : int, default 1
+        Seed of the hash functions.
+
+    Attributes
+    ----------
+    texts_ : dict[str, int]
+        Position of every kept snippet.
+
+    meta_ : list[dict]
+        Metadata of every kept snippet, duplicates of other documents are
+        added to its `sources`.
+
+    signatures_ : list[np.ndarray[uint64]]
+        MinHash signature of every kept snippet.
+
+    buckets_ : dict[tuple[int, bytes], list[int]]
+        Positions of the snippets per band and band signature.
+
+    duplicates_ : int
+        Suppressed snippets so far.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=3, seed=1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # a * x + b stays below 2**64 for 32 bit shingle hashes
+        self._a = rng.randint(1, 2**32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.randint(0, 2**32, size=(num_perm, 1), dtype=np.uint64)
+        self.texts_ = {}
+        self.meta_ = []
+        self.signatures_ = []
+        self.buckets_ = {}
+        self.duplicates_ = 0
+
+    def signature(self, text):
+        ''' MinHash signature of the word shingles of the text '''
+        words = re.findall(r'\w+', text.lower())
+        shingles = {" ".join(words[i:i + self.shingle_size]) for i in range(max(1, len(words) - self.shingle_size + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self._a * hashes + self._b) % np.uint64(prime)).min(axis=1)
+
+    def add(self, text, meta):
+        ''' Keep the snippet and return True if it is new, merge its metadata into the snippet it duplicates and return False otherwise '''
+        position = self.texts_.get(text)
+        if position is None and self.threshold:
+            signature = self.signature(text)
+            keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+            position = self._find(signature, keys)
+        if position is not None:
+            self.duplicates_ += 1
+            self._merge(self.meta_[position], meta)
+            return False
+        position = len(self.meta_)
+        self.texts_[text] = position
+        self.meta_.append(meta)
+        if self.threshold:
+            self.signatures_.append(signature)
+            for key in keys:
+                self.buckets_.setdefault(key, []).append(position)
+        return True
+
+    def _find(self, signature, keys):
+        candidates = sorted({position for key in keys for position in self.buckets_.get(key, [])})
+        for position in candidates:
+            if np.mean(self.signatures_[position] == signature) >= self.threshold:
+                return position
+        return None
+
+    def _merge(self, representative, meta):
+        if meta['document_id'] == representative['document_id']:
+            return
+        sources = representative.setdefault('sources', [])
+        if all(meta['document_id'] != source['document_id'] for source in sources):
+            sources.append({key: value for key, value in meta.items() if key != 'sources'})
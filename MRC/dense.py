@@ -0,0 +1,196 @@
+import os
+import hashlib
+import logging
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+from . import helper as he
+
+class Encoder:
+    """
+    Small sentence encoder on CPU. Texts are embedded as the mean of their
+    token states, normalized to unit length, so the dot product of two
+    embeddings is their cosine similarity.
+
+    Parameters
+    ----------
+    model_name_or_path : str
+        Sentence encoder, e.g. `sentence-transformers/all-MiniLM-L6-v2`.
+
+    max_seq_length : int, default 128
+        Tokens per text, longer texts are truncated.
+
+    batch_size : int, default 32
+        Texts per forward pass.
+    """
+
+    def __init__(self, model_name_or_path, max_seq_length=128, batch_size=32):
+        from transformers import AutoTokenizer, AutoModel
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        self.model = AutoModel.from_pretrained(model_name_or_path)
+        self.model.eval()
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+
+    def __call__(self, texts):
+        """
+        Embed texts.
+
+        Parameters
+        ----------
+        texts : list[str]
+
+        Returns
+        -------
+        embeddings : np.ndarray[float32]
+            `[len(texts), dim]`, one unit vector per text.
+        """
+        # Texts of similar length are embedded together, to keep the padding small
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = [None] * len(texts)
+        with torch.no_grad():
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                inputs = self.tokenizer(
+                    [texts[i] for i in batch],
+                    padding=True,
+                    truncation=True,
+                    max_length=self.max_seq_length,
+                    return_tensors='pt',
+                )
+                states = self.model(**inputs)[0]
+                mask = inputs['attention_mask'].unsqueeze(-1).to(states.dtype)
+                pooled = (states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                pooled = torch.nn.functional.normalize(pooled, dim=-1)
+                for i, embedding in zip(batch, pooled.numpy()):
+                    embeddings[i] = embedding
+        return np.asarray(embeddings, dtype=np.float32)
+
+class VectorIndex:
+    """
+    In-memory index of embeddings by key, e.g. the content hash of a
+    snippet. The least recently used embeddings are evicted first, and
+    their rows are reused.
+
+    Parameters
+    ----------
+    max_entries : int, default 100000
+        Maximum number of embeddings.
+
+    Attributes
+    ----------
+    vectors_ : np.ndarray[float32]
+        Embeddings, one per row, allocated as the index grows.
+
+    rows_ : OrderedDict[str, int]
+        Row of every key, least recently used first.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.vectors_ = None
+        self.rows_ = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, keys):
+        ''' Embeddings of the keys, None for the keys that are not in the index '''
+        with self._lock:
+            vectors = []
+            for key in keys:
+                row = self.rows_.get(key)
+                if row is not None:
+                    self.rows_.move_to_end(key)
+                    vectors.append(self.vectors_[row].copy())
+                else:
+                    vectors.append(None)
+            return vectors
+
+    def add(self, keys, vectors):
+        ''' Store the embeddings of the keys '''
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                if self.vectors_ is None:
+                    self.vectors_ = np.zeros((min(1024, self.max_entries), len(vector)), dtype=np.float32)
+                row = self.rows_.get(key)
+                if row is None:
+                    if len(self.rows_) >= self.max_entries:
+                        # Reuse the row of the least recently used embedding
+                        _, row = self.rows_.popitem(last=False)
+                    else:
+                        row = len(self.rows_)
+                        if row >= len(self.vectors_):
+                            # Grow geometrically up to the maximum
+                            vectors_ = np.zeros((min(2 * len(self.vectors_), self.max_entries), self.vectors_.shape[1]), dtype=np.float32)
+                            vectors_[:len(self.vectors_)] = self.vectors_
+                            self.vectors_ = vectors_
+                self.vectors_[row] = vector
+                self.rows_[key] = row
+                self.rows_.move_to_end(key)
+
+def embedding_key(text, model_name):
+    ''' Key of the embedding of a text in the `VectorIndex` '''
+    return hashlib.sha1(f'{model_name}\n{text}'.encode('utf-8')).hexdigest()
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse several scorings of the same documents by their ranks, every
+    scoring adds `1 / (k + rank)` to a document, ranks start at 1.
+
+    Parameters
+    ----------
+    rankings : list[np.ndarray[float64]]
+        Scores per document, higher is better.
+
+    k : int, default 60
+        Damps the influence of the top ranks.
+
+    Returns
+    -------
+    scores : np.ndarray[float64]
+        Fused score per document.
+    """
+    fused = np.zeros(len(rankings[0]), dtype=np.float64)
+    for scores in rankings:
+        ranks = np.empty(len(scores), dtype=np.float64)
+        ranks[np.argsort(-np.asarray(scores), kind='stable')] = np.arange(1, len(scores) + 1)
+        fused += 1.0 / (k + ranks)
+    return fused
+
+# The encoder is loaded on first use, the index keeps the embeddings of all snippets seen by the worker
+model_name = he.get_setting('dense', 'model', 'sentence-transformers/all-MiniLM-L6-v2')
+enabled = str(he.get_setting('dense', 'enabled', 'false')).lower() == 'true'
+index = VectorIndex(max_entries=int(he.get_setting('dense', 'max_entries', 100000)))
+encoder = None
+encoder_lock = threading.Lock()
+
+def get_encoder():
+    ''' Shared encoder, loaded from `./models/encoder/` if available, remote otherwise '''
+    global encoder
+    with encoder_lock:
+        if encoder is None:
+            if os.path.exists('./models/encoder/config.json'):
+                logging.warning('[INFO] - Loading local encoder.')
+                encoder = Encoder('./models/encoder/')
+            else:
+                logging.warning(f'[INFO] - Loading remote encoder {model_name}.')
+                encoder = Encoder(model_name)
+        return encoder
+
+def embed(texts):
+    ''' Embeddings of the texts, only the texts that are not in the index yet are encoded '''
+    keys = [embedding_key(text, model_name) for text in texts]
+    vectors = index.get(keys)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        encoded = get_encoder()([texts[i] for i in missing])
+        index.add([keys[i] for i in missing], encoded)
+        for i, vector in zip(missing, encoded):
+            vectors[i] = vector
+    logging.info(f'Embedded {len(missing)} of {len(texts)} texts, {len(texts) - len(missing)} from the index.')
+    return np.asarray(vectors, dtype=np.float32)
+
+def score(query, corpus):
+    ''' Cosine similarity of every document of the corpus to the query '''
+    vectors = embed([query] + list(corpus))
+    return (vectors[1:] @ vectors[0]).astype(np.float64)
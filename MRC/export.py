@@ -0,0 +1,99 @@
+import os
+import json
+import logging
+import argparse
+import torch
+from . import helper as he
+from .backends import PyTorchBackend, QuantizedBackend, OnnxBackend
+from .batcher import pad_batch
+from .features import convert_examples_to_features
+from .decoder import decode_predictions
+
+def export_onnx(model, tokenizer, path, opset_version=11):
+    ''' Export the question answering model to ONNX, with dynamic batch and sequence axes '''
+    model.to('cpu')
+    model.eval()
+    inputs = tokenizer("How many people live in New Zealand?", "New Zealand has a population of 4.9 million.", return_tensors='pt')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.onnx.export(
+        model,
+        (inputs['input_ids'], inputs['attention_mask']),
+        path,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['start_logits', 'end_logits'],
+        dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in ['input_ids', 'attention_mask', 'start_logits', 'end_logits']},
+        opset_version=opset_version,
+    )
+    logging.warning(f'[INFO] - Exported ONNX reader to {path}.')
+
+def quantize_onnx(path, quantized_path):
+    ''' Quantize the weights of an exported ONNX model to int8 '''
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    logging.warning(f'[INFO] - Quantized ONNX reader to {quantized_path}.')
+
+def load_fixtures(path):
+    ''' Load the fixture set, a list of {"question": ..., "contexts": [...]} '''
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def run_fixtures(backend, tokenizer, fixtures):
+    ''' Run a backend on every fixture, returns the logits per feature and the answers per fixture '''
+    results = []
+    for fixture in fixtures:
+        features = convert_examples_to_features(tokenizer, fixture['question'], fixture['contexts'])
+        input_ids, attention_mask = pad_batch([feature.input_ids for feature in features], tokenizer.pad_token_id)
+        start_logits, end_logits = backend(input_ids, attention_mask)
+        outputs = [(start_logits[i, :len(feature.input_ids)], end_logits[i, :len(feature.input_ids)]) for i, feature in enumerate(features)]
+        results.append((outputs, decode_predictions(features, outputs, fixture['contexts'])))
+    return results
+
+def check_backend(reference, backend, tokenizer, fixtures):
+    '''
+    Compare a backend against the fp32 reference on the fixture set, returns the largest
+    absolute difference of the logits and the share of answers that are the same
+    '''
+    max_diff = 0.0
+    same, total = 0, 0
+    for (ref_outputs, ref_answers), (outputs, answers) in zip(run_fixtures(reference, tokenizer, fixtures), run_fixtures(backend, tokenizer, fixtures)):
+        for (ref_start, ref_end), (start, end) in zip(ref_outputs, outputs):
+            max_diff = max(max_diff, (ref_start - start).abs().max().item(), (ref_end - end).abs().max().item())
+        same += sum(1 for ref_answer, answer in zip(ref_answers, answers) if ref_answer == answer)
+        total += len(ref_answers)
+    return dict(max_logit_diff = max_diff, answer_agreement = same / total if total else 1.0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and quantize the reader, and check it against the fp32 model.')
+    parser.add_argument('--model', default="deepset/bert-large-uncased-whole-word-masking-squad2", help='model name, see helper.load_models')
+    parser.add_argument('--model-path', default=None, help='local model folder, e.g. ./models/bert/, defaults to --model')
+    parser.add_argument('--backend', default='onnx', choices=['quantized', 'onnx'], help='backend to export and check')
+    parser.add_argument('--output', default='./models/bert/model.onnx', help='path of the exported ONNX model')
+    parser.add_argument('--quantize', action='store_true', help='quantize the exported ONNX model to int8, the fp32 model is kept next to it')
+    parser.add_argument('--check', action='store_true', help='compare the backend against the fp32 model on the fixtures')
+    parser.add_argument('--fixtures', default='./assets/reader_fixtures.json', help='fixture set for --check')
+    args = parser.parse_args()
+
+    config_class, model_class, tokenizer_class = he.load_models(args.model)
+    model_name_or_path = args.model_path or args.model
+    config = config_class.from_pretrained(model_name_or_path)
+    tokenizer = tokenizer_class.from_pretrained(model_name_or_path, do_lower_case=True)
+    model = model_class.from_pretrained(model_name_or_path, config=config)
+
+    if args.backend == 'onnx':
+        if args.quantize:
+            fp32_path = os.path.splitext(args.output)[0] + '.fp32.onnx'
+            export_onnx(model, tokenizer, fp32_path)
+            quantize_onnx(fp32_path, args.output)
+        else:
+            export_onnx(model, tokenizer, args.output)
+
+    if args.check:
+        reference = PyTorchBackend(model, torch.device('cpu'))
+        if args.backend == 'onnx':
+            backend = OnnxBackend(args.output)
+        else:
+            backend = QuantizedBackend(model)
+        print(json.dumps(check_backend(reference, backend, tokenizer, load_fixtures(args.fixtures)), indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import logging
+import numpy as np
+import torch
+from collections import namedtuple
+from .bm25 import stopwords
+
+# One window of a context, as passed to the reader
+# - example_index: index of the context the window belongs to
+# - input_ids: unpadded token ids of question and context window, incl. special tokens
+# - context_offset: position of the first context token in input_ids
+# - offsets: character offsets (start, end) into the context, per context token of the window
+# - subword: whether the token continues a word, i.e. a `##` word piece, per context token
+# - max_context: whether the window is the one with the most context for a token, per context token
+# - window: start and end of the window, in tokens of the context
+Feature = namedtuple('Feature', ['example_index', 'input_ids', 'context_offset', 'offsets', 'subword', 'max_context', 'window'])
+
+def tokenize_contexts(tokenizer, contexts):
+    ''' Tokenize all contexts in one call of the fast tokenizer, returns token ids, character offsets and word piece flags per context '''
+    encodings = tokenizer(
+        list(contexts),
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [
+        (
+            ids,
+            np.asarray(offsets, dtype=np.int64).reshape(-1, 2),
+            np.array([token.startswith('##') for token in tokenizer.convert_ids_to_tokens(ids)], dtype=bool)
+        )
+        for ids, offsets in zip(encodings['input_ids'], encodings['offset_mapping'])
+    ]
+
+def get_windows(n_tokens, window_length, doc_stride):
+    ''' Start and end token of the windows over a context, like the doc spans of squad_convert_examples_to_features '''
+    windows = []
+    start = 0
+    while start < n_tokens:
+        windows.append((start, min(start + window_length, n_tokens)))
+        if start + window_length >= n_tokens:
+            break
+        start += doc_stride
+    return windows
+
+def get_max_context(windows, n_tokens):
+    ''' Mask per window whether it is the window with the most context for each of its tokens '''
+    positions = np.arange(n_tokens)
+    scores = np.full((len(windows), n_tokens), -np.inf)
+    for i, (start, end) in enumerate(windows):
+        inside = slice(start, end)
+        left = positions[inside] - start
+        right = end - 1 - positions[inside]
+        scores[i, inside] = np.minimum(left, right) + 0.01 * (end - start)
+    # argmax picks the first window on ties, like _new_check_is_max_context
+    best = scores.argmax(axis=0) if windows else positions
+    return [best[start:end] == i for i, (start, end) in enumerate(windows)]
+
+def convert_examples_to_features(tokenizer, question, contexts, max_seq_length=384, doc_stride=128, max_query_length=64, tokenized=None):
+    '''
+    Build the reader features for a question and its contexts with the fast tokenizer.
+    Contexts longer than the sequence are split into overlapping windows, and the
+    features are left unpadded, so a batch only gets padded to its longest sequence.
+    The contexts may be passed already tokenized by `tokenize_contexts`, to share them between questions.
+    '''
+    query_ids = tokenizer(question, add_special_tokens=False)['input_ids'][:max_query_length]
+    # Locate the context within the special tokens of the model, e.g. [CLS] query [SEP] context [SEP]
+    context_offset = tokenizer.build_inputs_with_special_tokens(query_ids, [-1]).index(-1)
+    window_length = max_seq_length - len(query_ids) - tokenizer.num_special_tokens_to_add(pair=True)
+
+    features = []
+    for example_index, (context_ids, offsets, subword) in enumerate(tokenized if tokenized is not None else tokenize_contexts(tokenizer, contexts)):
+        windows = get_windows(len(context_ids), window_length, doc_stride)
+        for (start, end), max_context in zip(windows, get_max_context(windows, len(context_ids))):
+            input_ids = tokenizer.build_inputs_with_special_tokens(query_ids, context_ids[start:end])
+            features.append(Feature(
+                example_index = example_index,
+                input_ids = torch.tensor(input_ids, dtype=torch.long),
+                context_offset = context_offset,
+                offsets = offsets[start:end],
+                subword = subword[start:end],
+                max_context = max_context,
+                window = (start, end)
+            ))
+    logging.info(f'Converted {len(contexts)} contexts to {len(features)} features.')
+    return features
+
+def get_query_terms(tokenizer, question):
+    ''' Token ids of the question that are words and no stopwords, to look for in the windows '''
+    ids = tokenizer(question, add_special_tokens=False)['input_ids']
+    tokens = tokenizer.convert_ids_to_tokens(ids)
+    # Word pieces are compared as they are, the markers of BERT (##) and RoBERTa/ALBERT (Ġ, ▁) are dropped to check for stopwords
+    words = [token.lstrip('#').lstrip('\u0120\u2581').lower() for token in tokens]
+    return np.unique([i for i, word in zip(ids, words) if word.isalnum() and word not in stopwords]).astype(np.int64)
+
+def prune_windows(features, query_terms):
+    '''
+    Drop the overflow windows of long contexts that contain none of the query terms.
+    The first window of a context is kept if none of its windows does, and the max
+    context of the remaining windows is computed again among them.
+    '''
+    by_example = {}
+    for feature in features:
+        by_example.setdefault(feature.example_index, []).append(feature)
+    pruned = []
+    for example_features in by_example.values():
+        if len(example_features) > 1:
+            kept = [
+                feature for feature in example_features
+                if np.isin(feature.input_ids[feature.context_offset:feature.context_offset + len(feature.offsets)].numpy(), query_terms).any()
+            ] or example_features[:1]
+            if len(kept) < len(example_features):
+                windows = [feature.window for feature in kept]
+                kept = [
+                    feature._replace(max_context = max_context)
+                    for feature, max_context in zip(kept, get_max_context(windows, example_features[-1].window[1]))
+                ]
+            example_features = kept
+        pruned.extend(example_features)
+    logging.info(f'Pruned {len(features) - len(pruned)} of {len(features)} windows without query terms.')
+    return pruned
@@ -0,0 +1,212 @@
+'''
+Store of tokenized contexts, so popular documents are tokenized once.
+
+The same documents come back from the search for many different questions, and every
+request tokenized their snippets again. The store keeps the token ids, character offsets
+and word piece flags of a context, keyed on a hash of its text and the model, within a
+memory budget. With a directory, entries are also written to disk as `.npy` files and
+memory-mapped when read, so the workers of a host share their warm entries through the
+page cache, and the least recently used files are removed once they exceed a disk budget.
+At request time only the question is tokenized, see `features.convert_examples_to_features`.
+'''
+import os
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from . import helper as he
+from . import telemetry
+from .features import tokenize_contexts
+
+def get_key(namespace, context):
+    ''' Key of a context tokenized by the tokenizer of namespace, e.g. the model name '''
+    return hashlib.sha1(f'{namespace}\n{context}'.encode('utf-8')).hexdigest()
+
+def to_array(tokenized):
+    ''' One int64 array of a tokenized context, with token id, start and end offset and word piece flag per token '''
+    ids, offsets, subword = tokenized
+    array = np.empty((len(ids), 4), dtype=np.int64)
+    array[:, 0] = ids
+    array[:, 1:3] = offsets
+    array[:, 3] = subword
+    return array
+
+def from_array(array):
+    ''' Tokenized context of an array of `to_array`, like an entry of `features.tokenize_contexts` '''
+    return array[:, 0].tolist(), array[:, 1:3], array[:, 3].astype(bool)
+
+class FeatureStore:
+    """
+    Tokenized contexts, least recently used entries are dropped first.
+
+    Parameters
+    ----------
+    max_bytes : int, default 64 MB
+        Memory budget of the entries, 32 bytes per token.
+
+    path : str, default None
+        Directory of the shared entries on disk, created if missing. The
+        directory may be cleared at any time.
+
+    max_disk_bytes : int, default 1 GB
+        Disk budget of the directory, the least recently used files are
+        removed once it is exceeded. No limit if None.
+
+    Attributes
+    ----------
+    hits_ : int
+        Contexts found in memory.
+
+    disk_hits_ : int
+        Contexts found on disk.
+
+    misses_ : int
+        Contexts that had to be tokenized.
+
+    bytes_ : int
+        Memory of the entries in memory.
+
+    disk_bytes_ : int
+        Size of the files on disk, as last counted by this process plus
+        the files it wrote since.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, path=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes_ = 0
+        self.hits_ = 0
+        self.disk_hits_ = 0
+        self.misses_ = 0
+        self.bytes_ = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.disk_bytes_ = sum(size for _, size, _ in self._list_files())
+
+    def get(self, key):
+        ''' Array of the key, from memory or disk, None if missing '''
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self.hits_ += 1
+                return array
+        array = self._load(key)
+        if array is None:
+            with self._lock:
+                self.misses_ += 1
+            return None
+        with self._lock:
+            self.disk_hits_ += 1
+        self._keep(key, array)
+        return array
+
+    def set(self, key, array):
+        ''' Store the array of a tokenized context, see `to_array` '''
+        self._keep(key, array)
+        if self.path and len(array):
+            self._save(key, array)
+
+    def tokenize(self, tokenizer, contexts, namespace):
+        ''' Tokenized contexts like `features.tokenize_contexts`, only the contexts missing in the store are tokenized '''
+        keys = [get_key(namespace, context) for context in contexts]
+        arrays = [self.get(key) for key in keys]
+        missing = [i for i, array in enumerate(arrays) if array is None]
+        telemetry.count('reader.contexts_pretokenized', len(contexts) - len(missing))
+        if missing:
+            for i, tokenized in zip(missing, tokenize_contexts(tokenizer, [contexts[i] for i in missing])):
+                arrays[i] = to_array(tokenized)
+                self.set(keys[i], arrays[i])
+        return [from_array(array) for array in arrays]
+
+    def stats(self):
+        ''' Hit and miss counters, and memory of the entries '''
+        with self._lock:
+            return dict(hits = self.hits_, disk_hits = self.disk_hits_, misses = self.misses_, entries = len(self._entries), bytes = self.bytes_, disk_bytes = self.disk_bytes_)
+
+    def _keep(self, key, array):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes_ -= previous.nbytes
+            self._entries[key] = array
+            self.bytes_ += array.nbytes
+            while self.bytes_ > self.max_bytes and self._entries:
+                self.bytes_ -= self._entries.popitem(last=False)[1].nbytes
+
+    def _load(self, key):
+        if not self.path:
+            return None
+        file_path = os.path.join(self.path, key + '.npy')
+        try:
+            array = np.load(file_path, mmap_mode='r')
+            # The modification time tells the least recently used files
+            os.utime(file_path)
+            return array
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, key, array):
+        # Written under a name of its own and renamed, so other workers never map a partial file
+        file_path = os.path.join(self.path, key + '.npy')
+        temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(temp_path, file_path)
+            size = os.path.getsize(file_path)
+        except OSError as e:
+            logging.warning(f'[INFO] - Could not write the tokenized context to {file_path}: {e}')
+            return
+        with self._lock:
+            self.disk_bytes_ += size
+            exceeded = self.max_disk_bytes is not None and self.disk_bytes_ > self.max_disk_bytes
+        if exceeded:
+            self._evict()
+
+    def _list_files(self):
+        ''' Path, size and modification time of the files on disk '''
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict(self):
+        ''' Remove the least recently used files, until the directory is at 90% of its budget '''
+        files = sorted(self._list_files(), key=lambda file: file[2])
+        disk_bytes = sum(size for _, size, _ in files)
+        removed = 0
+        for file_path, size, _ in files:
+            if disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                # Workers that mapped the file keep their mapping, where the platform allows to remove it
+                os.remove(file_path)
+            except OSError:
+                continue
+            disk_bytes -= size
+            removed += 1
+        with self._lock:
+            self.disk_bytes_ = disk_bytes
+        logging.info(f'Removed {removed} tokenized contexts from {self.path}, {disk_bytes} bytes left.')
+
+# The store is kept at module scope, so it stays warm across requests of a worker
+max_mb = int(he.get_setting('reader', 'feature_store_mb', 64))
+if max_mb > 0:
+    store = FeatureStore(
+        max_mb * 2**20,
+        he.get_setting('reader', 'feature_store_path') or None,
+        max_disk_bytes=int(he.get_setting('reader', 'feature_store_disk_mb', 1024)) * 2**20 or None
+    )
+    logging.info(f'Feature store enabled, shared path: {store.path}.')
+else:
+    store = None
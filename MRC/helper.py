@@ -1,9 +1,90 @@
 import logging
-import sys
+import os
+import json
+import configparser
+
+# Local settings, the environment is used as fallback on the deployed function
+config = configparser.ConfigParser()
+config.read('config.ini')
 
 def main():
     return None
 
+def get_setting(section, option, fallback=None):
+    '''
+    Get a setting from the config.ini, or from the environment variable `<section>_<option>`
+    '''
+    value = config.get(section, option, fallback=None)
+    if value is None or value == '':
+        value = os.environ.get(f'{section}_{option}', fallback)
+    return value
+
+def get_param(req, name):
+    '''
+    Get an optional parameter from the url or the request body, None if missing
+    '''
+    value = req.params.get(name)
+    if value is None:
+        try:
+            value = req.get_json().get(name)
+        except (ValueError, AttributeError):
+            pass
+    return value
+
+def get_questions(req):
+    '''
+    Get the list of questions of a batch request, None if it is not one.
+    The list is cut to `max_questions` of the `[batch]` settings
+    '''
+    questions = get_param(req, 'questions')
+    if isinstance(questions, str):
+        # In the url, the questions are passed as JSON list
+        try:
+            questions = json.loads(questions)
+        except ValueError:
+            logging.warning('Received questions that are no JSON list, ignoring them')
+            return None
+    if not isinstance(questions, list) or not questions:
+        return None
+    max_questions = int(get_setting('batch', 'max_questions', 100))
+    if len(questions) > max_questions:
+        logging.warning(f'Received {len(questions)} questions, only answering the first {max_questions}')
+    return [str(question) for question in questions[:max_questions]]
+
+def get_adaptive(req):
+    '''
+    Get whether to read adaptively, i.e. stop reading once a confident answer is found,
+    the `adaptive` setting of the `[reader]` section by default
+    '''
+    adaptive = get_param(req, 'adaptive')
+    if adaptive is None:
+        adaptive = get_setting('reader', 'adaptive', 'false')
+    return str(adaptive).lower() == 'true'
+
+def get_timings(req):
+    '''
+    Get whether to add the timings of the pipeline stages to the response,
+    the `timings` setting of the `[telemetry]` section by default
+    '''
+    timings = get_param(req, 'timings')
+    if timings is None:
+        timings = get_setting('telemetry', 'timings', 'false')
+    return str(timings).lower() == 'true'
+
+def get_stream_config(req):
+    '''
+    Get the parameters of the streaming mode: whether to stream, and the early stop
+    after max_answers answers with at least min_score (0 streams all answers)
+    '''
+    stream = str(get_param(req, 'stream')).lower() == 'true'
+    max_answers = get_param(req, 'max_answers')
+    if max_answers is None:
+        max_answers = get_setting('stream', 'max_answers', 0)
+    min_score = get_param(req, 'min_score')
+    if min_score is None:
+        min_score = get_setting('stream', 'min_score', 0.0)
+    return stream, int(max_answers), float(min_score)
+
 def get_config(req):
     '''
     Get config and set parameters
@@ -42,8 +123,21 @@ def get_config(req):
             tokenize = True
     elif all([question, n_doc, treshold, tokenize, bm_n_doc]):
         pass
-    logging.warning(f'[INFO] - Working with following parameters: n_doc: {n_doc}, treshold: {treshold}, bm_n_doc: {bm_n_doc}, tokenize: {tokenize}.')
-    return question, int(n_doc), int(treshold), tokenize, int(bm_n_doc)
+    # The reader model is optional, the default model of the reader is used otherwise
+    model = get_param(req, 'model')
+    if model and model not in model_types:
+        logging.warning(f'Model {model} is not available, using the default model')
+        model = None
+    logging.warning(f'[INFO] - Working with following parameters: n_doc: {n_doc}, treshold: {treshold}, bm_n_doc: {bm_n_doc}, tokenize: {tokenize}, model: {model}.')
+    return question, int(n_doc), int(treshold), tokenize, int(bm_n_doc), model
+
+# Supported models and their type, which is also the folder of the local model in ./models/
+model_types = {
+    "deepset/bert-large-uncased-whole-word-masking-squad2": "bert",
+    "deepset/roberta-base-squad2": "roberta",
+    "twmkn9/albert-base-v2-squad2": "albert",
+    "distilbert-base-cased-distilled-squad": "distilbert",
+}
 
 def load_models(model_name_or_path):
     '''
@@ -59,43 +153,39 @@ def load_models(model_name_or_path):
         from transformers import (
             AlbertConfig,
             AlbertForQuestionAnswering,
-            AlbertTokenizer,
-            squad_convert_examples_to_features
+            AlbertTokenizerFast
         )
         config_class, model_class, tokenizer_class = (
-            AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizer)
+            AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizerFast)
     elif model_name_or_path == "deepset/bert-large-uncased-whole-word-masking-squad2":
         from transformers import (
             BertConfig,
             BertForQuestionAnswering,
-            BertTokenizer,
-            squad_convert_examples_to_features
+            BertTokenizerFast
         )
         config_class, model_class, tokenizer_class = (
-            BertConfig, BertForQuestionAnswering, BertTokenizer)
+            BertConfig, BertForQuestionAnswering, BertTokenizerFast)
     elif model_name_or_path == "distilbert-base-cased-distilled-squad":
         from transformers import (
             DistilBertConfig,
             DistilBertForQuestionAnswering,
-            DistilBertTokenizer,
-            squad_convert_examples_to_features
+            DistilBertTokenizerFast
         )
         config_class, model_class, tokenizer_class = (
-            DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizer)
+            DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizerFast)
     elif model_name_or_path == "deepset/roberta-base-squad2":
         from transformers import (
             RobertaConfig,
             RobertaForQuestionAnswering,
-            RobertaTokenizer,
-            squad_convert_examples_to_features
+            RobertaTokenizerFast
         )
         config_class, model_class, tokenizer_class = (
-            RobertaConfig, RobertaForQuestionAnswering, RobertaTokenizer)
+            RobertaConfig, RobertaForQuestionAnswering, RobertaTokenizerFast)
     else:
         logging.error(f'Model {model_name_or_path} is not available!')
-        sys.exit()
+        raise ValueError(f'Model {model_name_or_path} is not available, pick one of {list(model_types)}')
     logging.info(f'Loaded {model_name_or_path} ...')
-    return config_class, model_class, tokenizer_class, squad_convert_examples_to_features
+    return config_class, model_class, tokenizer_class
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
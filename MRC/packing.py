@@ -0,0 +1,86 @@
+'''
+Packing of short snippets into fewer reader sequences.
+
+The snippets of the retriever are mostly one or two sentences, far shorter than a
+sequence of the reader. Snippets of the same document are measured in tokens of the
+reader and joined into one context, as long as they fit next to the question, so one
+forward pass reads several of them. Every snippet stays whole, so sentence boundaries
+are kept, and the answer of a packed context is mapped back to the snippet it starts in,
+by its character offset from the decoder.
+'''
+import bisect
+from collections import namedtuple
+
+# Snippets packed into one context of the reader
+# - text: the snippets, joined by a space
+# - starts: character offset of every snippet in the text
+# - indices: index of every snippet in the documents
+Pack = namedtuple('Pack', ['text', 'starts', 'indices'])
+
+def get_budget(tokenizer, question, max_seq_length=384, max_query_length=64):
+    ''' Context tokens that fit into one sequence next to the question, like the windows of `features.convert_examples_to_features` '''
+    query_ids = tokenizer(question, add_special_tokens=False)['input_ids'][:max_query_length]
+    return max_seq_length - len(query_ids) - tokenizer.num_special_tokens_to_add(pair=True)
+
+def pack_snippets(tokenizer, question, documents, meta, max_seq_length=384, max_query_length=64):
+    """
+    Pack the snippets of the same document into as few contexts as fit the
+    token budget of the reader.
+
+    Parameters
+    ----------
+    tokenizer : transformers.PreTrainedTokenizerFast
+        Tokenizer of the reader, the snippets are measured in its tokens.
+
+    question : str
+
+    documents : list[str]
+        Snippets, best first.
+
+    meta : list[dict]
+        Metadata per snippet, snippets with the same `document_id` may be packed.
+
+    max_seq_length, max_query_length : int
+        Sequence and question length of the reader.
+
+    Returns
+    -------
+    packs : list[Pack]
+        Packed contexts, in the order of their best snippet. The snippets of a
+        pack keep their order. Snippets longer than the budget get a pack of
+        their own, the reader splits them into windows.
+    """
+    budget = get_budget(tokenizer, question, max_seq_length, max_query_length)
+    lengths = [len(ids) for ids in tokenizer(
+        list(documents),
+        add_special_tokens=False,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )['input_ids']]
+    packs = []
+    # Pack per document that still has room, with its tokens so far
+    open_packs = {}
+    for i, (document, m, length) in enumerate(zip(documents, meta, lengths)):
+        key = m['document_id']
+        if key in open_packs and open_packs[key][1] + length <= budget:
+            pack, tokens = open_packs[key]
+            pack.append(i)
+            open_packs[key] = (pack, tokens + length)
+        else:
+            pack = [i]
+            packs.append(pack)
+            open_packs[key] = (pack, length)
+    return [to_pack([documents[i] for i in pack], pack) for pack in packs]
+
+def to_pack(snippets, indices):
+    ''' Pack of the snippets, joined by a space '''
+    starts = []
+    position = 0
+    for snippet in snippets:
+        starts.append(position)
+        position += len(snippet) + 1
+    return Pack(text = " ".join(snippets), starts = starts, indices = indices)
+
+def locate(pack, start):
+    ''' Index in the documents of the snippet that holds the answer starting at character start of the pack, see `decoder.decode_predictions` '''
+    return pack.indices[max(0, bisect.bisect_right(pack.starts, start) - 1)]
@@ -0,0 +1,99 @@
+'''
+Streaming variant of the retrieve -> read pipeline of `__init__.py`.
+
+The snippets of the search results are handed to the reader as they are extracted,
+and the reader reads them in small batches. Every answer is yielded as soon as its
+batch is read, and the pipeline stops early once enough confident answers were found.
+'''
+import json
+import logging
+import argparse
+
+from . import retriever
+from . import reader
+from . import helper as he
+
+def stream_answers(question, n_doc=5, treshold=5, tokenize=True, model=None, max_answers=0, min_score=0.0, batch_size=None):
+    """
+    Run the pipeline on a question and yield its answers as they are found.
+
+    Parameters
+    ----------
+    question : str
+
+    n_doc, treshold, tokenize :
+        Parameters of the retriever, see `retriever.main`.
+
+    model : str, default None
+        Reader model, the default model if None.
+
+    max_answers : int, default 0
+        Stop once this many answers have a score of at least `min_score`,
+        i.e. no further snippets are searched or read. 0 reads all snippets.
+
+    min_score : float, default 0.0
+        Score an answer needs to count towards `max_answers`. The score is by
+        how much the answer beats the null answer, see `decoder.py`.
+
+    batch_size : int, default None
+        Snippets read per batch, `batch_size` in the `[stream]` section of the
+        `config.ini` if None.
+
+    Yields
+    ------
+    line : dict
+        Every answer as dict with its metadata and `score`. The last line holds
+        the `counts` of documents and answers, and whether the pipeline
+        `stopped_early`.
+    """
+    batch_size = batch_size or int(he.get_setting('stream', 'batch_size', 2))
+    documents = 0
+    answers = 0
+    confident = 0
+
+    def snippets():
+        nonlocal documents
+        # BM25 is skipped, it needs all snippets before it can rank them
+        for snippet in retriever.stream(question, n_doc, treshold, tokenize):
+            documents += 1
+            yield snippet
+
+    answer_stream = reader.stream(question, snippets(), model, batch_size)
+    stopped_early = False
+    for answer in answer_stream:
+        answers += 1
+        yield answer
+        if answer['score'] >= min_score:
+            confident += 1
+        if max_answers and confident >= max_answers:
+            # Closing the reader also closes the snippets and the search results
+            answer_stream.close()
+            stopped_early = True
+            logging.warning(f'[INFO] - Stopped early after {confident} answers with a score of at least {min_score}.')
+            break
+    yield dict(
+        counts = dict(
+            documents = documents,
+            answers = answers
+        ),
+        stopped_early = stopped_early
+    )
+
+def to_ndjson(lines):
+    ''' Serialize the lines of the pipeline as newline delimited JSON '''
+    for line in lines:
+        yield json.dumps(line) + '\n'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer a question and print the answers as NDJSON as soon as they are found.')
+    parser.add_argument('question')
+    parser.add_argument('--az-documents', type=int, default=5)
+    parser.add_argument('--az-treshold', type=int, default=5)
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--max-answers', type=int, default=0)
+    parser.add_argument('--min-score', type=float, default=0.0)
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+    lines = stream_answers(args.question, args.az_documents, args.az_treshold, True, args.model, args.max_answers, args.min_score, args.batch_size)
+    for line in to_ndjson(lines):
+        print(line, end='', flush=True)
@@ -0,0 +1,26 @@
+import logging
+from . import bm25
+from . import dense
+from . import telemetry
+from . import helper as he
+
+# Damping of the reciprocal rank fusion, see dense.reciprocal_rank_fusion
+rrf_k = int(he.get_setting('dense', 'rrf_k', 60))
+
+def main(query, corpus, sources, k):
+    '''
+    Cut the documents to the k best for the reader. BM25 alone by default, fused
+    with the dense similarity of a sentence encoder if the dense stage is enabled
+    '''
+    telemetry.count('ranker.documents', len(corpus))
+    if not dense.enabled:
+        with telemetry.span('bm25'):
+            return bm25.main(query, corpus, sources, k)
+    logging.warning('Applying hybrid BM25 and dense ranking ...')
+    with telemetry.span('bm25'):
+        bm25_scores = bm25.score(query, corpus)
+    with telemetry.span('dense'):
+        dense_scores = dense.score(query, corpus)
+    scores = dense.reciprocal_rank_fusion([bm25_scores, dense_scores], rrf_k)
+    ranked = bm25.top_k(scores, k)
+    return [corpus[i] for i in ranked], [sources[i] for i in ranked]
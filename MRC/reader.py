@@ -1,149 +1,427 @@
 import os
 import logging
+import threading
 import torch
 import time
 from . import helper as he
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
-
-from transformers.data.processors.squad import SquadResult, SquadV2Processor, SquadExample
-from transformers.data.metrics.squad_metrics import compute_predictions_logits
-
-# Define model - just uncomment the model you want to use
-model_type = "bert" # may be bert, roberta, albert, distilbert, see helper.py
-model_name_or_path = "deepset/bert-large-uncased-whole-word-masking-squad2"
-
-# Set the flag for deployment
-if os.path.exists(f'./models/{model_type}/config.json'):
-    # Load supported models
-    config_class, model_class, tokenizer_class, squad_convert_examples_to_features = he.load_models(model_name_or_path)
-    model_name_or_path = f'./models/{model_type}/'
-    logging.warning(f'[INFO] - Loading local model {model_type}.')
-else:
-    # Load supported models
-    config_class, model_class, tokenizer_class, squad_convert_examples_to_features = he.load_models(model_name_or_path)
-    logging.warning(f'[INFO] - Loading remote model {model_type}.')
+from . import cache
+from . import telemetry
+from . import packing
+from . import featurestore
+from .batcher import BatchScheduler
+from .backends import load_backend
+from .features import convert_examples_to_features, tokenize_contexts, get_query_terms, prune_windows
+from .decoder import decode_predictions
+from .registry import ModelRegistry
+
+startup = time.perf_counter()
+
+# Define model - just set the model you want to use as default, see helper.py
+# Further models may be picked per request and are loaded on first use
+default_model = he.get_setting('reader', 'model', "deepset/bert-large-uncased-whole-word-masking-squad2")
 
 # Config
-n_best_size = 1
 max_answer_length = 50
 do_lower_case = True
 null_score_diff_threshold = 0.0
 
-def to_list(tensor):
-    return tensor.detach().cpu().tolist()
+# Adaptive reading, see run_adaptive_prediction
+adaptive_batch_size = int(he.get_setting('reader', 'adaptive_batch_size', 1))
+adaptive_margin = float(he.get_setting('reader', 'adaptive_margin', 5.0))
+adaptive_prune_windows = str(he.get_setting('reader', 'adaptive_prune_windows', 'true')).lower() == 'true'
 
-# Setup model
-config = config_class.from_pretrained(model_name_or_path)
-tokenizer = tokenizer_class.from_pretrained(
-    model_name_or_path, do_lower_case=do_lower_case)
-model = model_class.from_pretrained(model_name_or_path, config=config)
+# Short snippets of the same document are read together, see packing.py
+pack_contexts = str(he.get_setting('reader', 'pack_contexts', 'false')).lower() == 'true'
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-model.to(device)
+class Reader:
+    """
+    A loaded reader model, with its tokenizer, backend and batch scheduler.
+
+    Parameters
+    ----------
+    model_name : str
+        One of the models in helper.py, loaded from `./models/<model type>/`
+        if available, remote otherwise.
+    """
+
+    def __init__(self, model_name):
+        # Load supported models
+        config_class, model_class, tokenizer_class = he.load_models(model_name)
+        model_type = he.model_types[model_name]
+        # Set the flag for deployment
+        if os.path.exists(f'./models/{model_type}/config.json'):
+            model_name_or_path = f'./models/{model_type}/'
+            logging.warning(f'[INFO] - Loading local model {model_type}.')
+        else:
+            model_name_or_path = model_name
+            logging.warning(f'[INFO] - Loading remote model {model_type}.')
+
+        # Setup model
+        config = config_class.from_pretrained(model_name_or_path)
+        self.tokenizer = tokenizer_class.from_pretrained(
+            model_name_or_path, do_lower_case=do_lower_case)
+
+        # Backend to run the model with, may be pytorch, quantized or onnx, see backends.py
+        self.backend = load_backend(
+            he.get_setting('reader', 'backend', 'pytorch'),
+            model_class,
+            config,
+            model_name_or_path,
+            device,
+            onnx_path=he.get_setting('reader', 'onnx_path', f'./models/{model_type}/model.onnx'),
+            weights_path=he.get_setting('reader', 'pool_weights_path', f'./models/{model_type}/weights.bin'),
+            processes=int(he.get_setting('reader', 'pool_processes', 0)) or None,
+            threads_per_process=int(he.get_setting('reader', 'pool_threads', 1)),
+        )
+        self.size = self.backend.size
+
+        # Forward passes of concurrent requests are batched together
+        self.scheduler = BatchScheduler(
+            self.backend,
+            pad_token_id=self.tokenizer.pad_token_id,
+            max_batch_size=int(he.get_setting('reader', 'max_batch_size', 16)),
+            max_latency=float(he.get_setting('reader', 'max_latency_ms', 10)) / 1000,
+            # The worker pool runs one batch per process at once
+            max_concurrency=getattr(self.backend, 'concurrency', 1),
+            max_pending=int(he.get_setting('reader', 'max_pending_features', 0)) or None,
+        )
+
+    def close(self):
+        self.scheduler.close()
+        if hasattr(self.backend, 'close'):
+            self.backend.close()
+
+# Models are loaded on first use and evicted least recently used first, once they exceed the budget
+registry = ModelRegistry(Reader, memory_budget=int(he.get_setting('reader', 'memory_budget_mb', 0)) * 2**20 or None)
+
+def tokenize(reader, contexts, model_name):
+    ''' Tokenized contexts, from the feature store if it is enabled, see featurestore.py '''
+    if featurestore.store is None:
+        return tokenize_contexts(reader.tokenizer, contexts)
+    tokenized = featurestore.store.tokenize(reader.tokenizer, contexts, model_name)
+    logging.info(f'Feature store: {featurestore.store.stats()}')
+    return tokenized
+
+def get_cached_span(question_text, context_text, model_name):
+    ''' Cached answer, score and character offset of a context for the same question '''
+    if cache.spans is None:
+        return None
+    prediction = cache.spans.get(cache.span_key(question_text, context_text, model_name))
+    return tuple(prediction) if prediction is not None else None
+
+def set_cached_span(question_text, context_text, model_name, prediction):
+    if cache.spans is not None:
+        cache.spans.set(cache.span_key(question_text, context_text, model_name), list(prediction))
+
+def run_prediction(question_text, context_texts, model_name=None):
+    """
+    Setup function to compute predictions, returns the answer, its score and its
+    character offset in the context per context
+    """
+    model_name = model_name or default_model
+    # Contexts that were already read for the same question reuse their prediction
+    predictions = [get_cached_span(question_text, context_text, model_name) for context_text in context_texts]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    telemetry.count('reader.contexts', len(context_texts))
+    telemetry.count('reader.contexts_cached', len(context_texts) - len(missing))
+    if not missing:
+        return predictions
+
+    # The model is not closed while this request runs, even if it is evicted meanwhile
+    with registry.use(model_name) as reader:
+        with telemetry.span('reader.features'):
+            features = convert_examples_to_features(
+                reader.tokenizer,
+                question_text,
+                [context_texts[i] for i in missing],
+                max_seq_length=384,
+                doc_stride=128,
+                max_query_length=64,
+                tokenized=tokenize(reader, [context_texts[i] for i in missing], model_name),
+            )
+        telemetry.count('reader.features', len(features))
+
+        # Hand the unpadded features to the scheduler, it batches them with other requests
+        with telemetry.span('reader.forward'):
+            outputs = reader.scheduler.submit([feature.input_ids for feature in features])
+
+        with telemetry.span('reader.decode'):
+            _predictions, _scores, _starts = decode_predictions(
+                features,
+                outputs,
+                [context_texts[i] for i in missing],
+                max_answer_length,
+                null_score_diff_threshold,
+                return_scores=True,
+                return_starts=True,
+            )
+
+        for i, prediction, score, answer_start in zip(missing, _predictions, _scores, _starts):
+            predictions[i] = (prediction, score, answer_start)
+            set_cached_span(question_text, context_texts[i], model_name, predictions[i])
+        return predictions
+
+def run_batch_prediction(question_texts, context_texts, model_name=None):
+    """
+    Compute the predictions of many questions at once, returns the answer, its score and
+    its character offset per context of every question. Contexts shared by several questions are tokenized once,
+    and the features of all questions are read in shared batches, sorted by length.
+    """
+    model_name = model_name or default_model
+    predictions = []
+    missing = []
+    for question_text, contexts in zip(question_texts, context_texts):
+        _predictions = [get_cached_span(question_text, context_text, model_name) for context_text in contexts]
+        predictions.append(_predictions)
+        missing.append([i for i, prediction in enumerate(_predictions) if prediction is None])
+    telemetry.count('reader.contexts', sum(len(contexts) for contexts in context_texts))
+    telemetry.count('reader.contexts_cached', sum(len(contexts) - len(_missing) for contexts, _missing in zip(context_texts, missing)))
+    if not any(missing):
+        return predictions
 
-processor = SquadV2Processor()
+    # The model is not closed while this request runs, even if it is evicted meanwhile
+    with registry.use(model_name) as reader:
+        unique_contexts = list(dict.fromkeys(contexts[i] for contexts, _missing in zip(context_texts, missing) for i in _missing))
+        with telemetry.span('reader.features'):
+            tokenized = dict(zip(unique_contexts, tokenize(reader, unique_contexts, model_name)))
+            logging.info(f'Tokenized {len(unique_contexts)} unique contexts of {len(question_texts)} questions.')
+            features = [
+                convert_examples_to_features(
+                    reader.tokenizer,
+                    question_text,
+                    [contexts[i] for i in _missing],
+                    max_seq_length=384,
+                    doc_stride=128,
+                    max_query_length=64,
+                    tokenized=[tokenized[contexts[i]] for i in _missing],
+                ) if _missing else []
+                for question_text, contexts, _missing in zip(question_texts, context_texts, missing)
+            ]
 
-def run_prediction(question_text, context_texts):
+        # Hand the features of all questions to the scheduler at once, sorted by length to keep the padding small
+        rows = [feature.input_ids for _features in features for feature in _features]
+        telemetry.count('reader.features', len(rows))
+        order = sorted(range(len(rows)), key=lambda i: len(rows[i]))
+        outputs = [None] * len(rows)
+        with telemetry.span('reader.forward'):
+            for i, output in zip(order, reader.scheduler.submit([rows[i] for i in order])):
+                outputs[i] = output
+
+        start = 0
+        for question_text, contexts, _missing, _features, _predictions in zip(question_texts, context_texts, missing, features, predictions):
+            _outputs, start = outputs[start:start + len(_features)], start + len(_features)
+            if not _missing:
+                continue
+            with telemetry.span('reader.decode'):
+                answers, scores, answer_starts = decode_predictions(
+                    _features,
+                    _outputs,
+                    [contexts[i] for i in _missing],
+                    max_answer_length,
+                    null_score_diff_threshold,
+                    return_scores=True,
+                    return_starts=True,
+                )
+            for i, answer, score, answer_start in zip(_missing, answers, scores, answer_starts):
+                _predictions[i] = (answer, score, answer_start)
+                set_cached_span(question_text, contexts[i], model_name, _predictions[i])
+        return predictions
+
+def run_adaptive_prediction(question_text, context_texts, model_name=None, batch_size=None, margin=None, prune=None):
     """
-    Setup function to compute predictions
+    Read the contexts in their order, best first, in small batches and stop once an
+    answer beats the null answer by the margin. Overflow windows without any query
+    term are skipped. Returns the answer, its score and its character offset per context, contexts that
+    were not read get no answer, and the reader compute that was saved. Contexts with a cached
+    prediction are not read and count neither as read nor as saved.
     """
-    examples = []
-
-    for i, context_text in enumerate(context_texts):
-        example = SquadExample(
-            qas_id=str(i),
-            question_text=question_text,
-            context_text=context_text,
-            answer_text=None,
-            start_position_character=None,
-            title="Predict",
-            is_impossible=False,
-            answers=None,
+    model_name = model_name or default_model
+    batch_size = batch_size or adaptive_batch_size
+    margin = adaptive_margin if margin is None else margin
+    prune = adaptive_prune_windows if prune is None else prune
+    # The model is not closed while this request runs, even if it is evicted meanwhile
+    with registry.use(model_name) as reader:
+        # Tokenizing all contexts is cheap, it tells how much a full read would cost
+        with telemetry.span('reader.features'):
+            features = convert_examples_to_features(
+                reader.tokenizer,
+                question_text,
+                context_texts,
+                max_seq_length=384,
+                doc_stride=128,
+                max_query_length=64,
+                tokenized=tokenize(reader, context_texts, model_name),
+            )
+        telemetry.count('reader.contexts', len(context_texts))
+        telemetry.count('reader.features', len(features))
+        # Contexts that were already read for the same question reuse their prediction
+        cached = [get_cached_span(question_text, context_text, model_name) for context_text in context_texts]
+        stats = dict(
+            documents = len(context_texts),
+            documents_read = 0,
+            documents_cached = 0,
+            windows = len(features),
+            windows_pruned = 0,
+            # The cost of a full read, without the contexts the cache answers
+            tokens = sum(len(feature.input_ids) for feature in features if cached[feature.example_index] is None),
+            tokens_read = 0,
         )
-        examples.append(example)
-
-    features, dataset = squad_convert_examples_to_features(
-        examples=examples,
-        tokenizer=tokenizer,
-        max_seq_length=384,
-        doc_stride=128,
-        max_query_length=64,
-        is_training=False,
-        return_dataset="pt",
-        threads=1,
-    )
+        if prune:
+            windows = {}
+            for feature in features:
+                windows[feature.example_index] = windows.get(feature.example_index, 0) + 1
+            features = prune_windows(features, get_query_terms(reader.tokenizer, question_text))
+            for feature in features:
+                windows[feature.example_index] -= 1
+            stats['windows_pruned'] = stats['windows'] - len(features)
 
-    eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=10)
-
-    all_results = []
-
-    for batch in eval_dataloader:
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
-
-        with torch.no_grad():
-            inputs = {
-                "input_ids": batch[0],
-                "attention_mask": batch[1],
-                #"token_type_ids": batch[2], #TODO: had to comment this?
-            }
-
-            example_indices = batch[3]
-
-            outputs = model(**inputs)
-
-            for i, example_index in enumerate(example_indices):
-                eval_feature = features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
-
-                output = [to_list(output[i]) for output in outputs]
-
-                start_logits, end_logits = output
-                result = SquadResult(unique_id, start_logits, end_logits)
-                all_results.append(result)
-
-    # Output files are optional, may help debugging/learning locally
-    # output_prediction_file = "/tmp/predictions.json"
-    # output_nbest_file = "/tmp/nbest_predictions.json"
-    # output_null_log_odds_file = "/tmp/null_predictions.json"
-
-    predictions = compute_predictions_logits(
-        examples,
-        features,
-        all_results,
-        n_best_size,
-        max_answer_length, # TODO
-        do_lower_case,
-        None,
-        None,
-        None,
-        False, # verbose_logging
-        True,  # version_2_with_negative
-        null_score_diff_threshold,
-        tokenizer,
+        predictions = [("", -float('inf'), -1) for _ in context_texts]
+        for start in range(0, len(context_texts), batch_size):
+            batch = range(start, min(start + batch_size, len(context_texts)))
+            missing = []
+            for i in batch:
+                if cached[i] is None:
+                    missing.append(i)
+                else:
+                    predictions[i] = cached[i]
+            batch_features = [feature for feature in features if feature.example_index in missing]
+            if batch_features:
+                with telemetry.span('reader.forward'):
+                    outputs = reader.scheduler.submit([feature.input_ids for feature in batch_features])
+                stats['tokens_read'] += sum(len(feature.input_ids) for feature in batch_features)
+                with telemetry.span('reader.decode'):
+                    answers, scores, answer_starts = decode_predictions(
+                        batch_features,
+                        outputs,
+                        context_texts,
+                        max_answer_length,
+                        null_score_diff_threshold,
+                        return_scores=True,
+                        return_starts=True,
+                    )
+                for i in missing:
+                    predictions[i] = (answers[i], scores[i], answer_starts[i])
+                    # Only predictions of all windows are cached, they hold for the full read as well
+                    if not (prune and windows.get(i, 0)):
+                        set_cached_span(question_text, context_texts[i], model_name, predictions[i])
+            stats['documents_read'] += len(missing)
+            stats['documents_cached'] += len(batch) - len(missing)
+            if any(answer != "" and score >= margin for answer, score, _ in predictions[batch.start:batch.stop]):
+                logging.info(f'Stopped reading after {batch.stop} of {len(context_texts)} contexts, {stats["documents_cached"]} of them cached.')
+                break
+        stats['compute_saved'] = round(1 - stats['tokens_read'] / stats['tokens'], 4) if stats['tokens'] else 0.0
+        return predictions, stats
+
+def warm_up(model_name=None):
+    ''' Load a model and run a dummy forward pass, so that the first request does not pay for it '''
+    start = time.perf_counter()
+    run_prediction("What is this?", ["This is a warm-up of the reader."], model_name)
+    logging.warning(f'[INFO] - Warm-up of {model_name or default_model} took {time.perf_counter() - start:.2f}s.')
+
+def format_answer(answer, m, score=None):
+    prediction = dict(
+        answer = answer,
+        title = m['title'],
+        metadata_storage_name = m['metadata_storage_name'],
+        document_id = m['document_id'],
+        document_uri = m['document_uri']
     )
+    if m.get('sources'):
+        # Other documents with (nearly) the same text, see dedup.py
+        prediction['sources'] = m['sources']
+    if score is not None:
+        prediction['score'] = round(score, 4)
+    return prediction
 
-    return predictions
+def pack(question, documents, meta, model_name=None):
+    ''' Packs of the snippets for the reader, a pack per snippet if packing is off '''
+    if not pack_contexts:
+        return [packing.Pack(text = document, starts = [0], indices = [i]) for i, document in enumerate(documents)]
+    packs = packing.pack_snippets(registry.get(model_name or default_model).tokenizer, question, documents, meta)
+    telemetry.count('reader.packs', len(packs))
+    logging.info(f'Packed {len(documents)} snippets into {len(packs)} contexts.')
+    return packs
 
-def main(question, documents, meta):
+first_request = True
+
+def main(question, documents, meta, model_name=None):
+    global first_request
+    start = time.perf_counter()
     # Run method
-    _predictions = run_prediction(question, documents)
+    packs = pack(question, documents, meta, model_name)
+    _predictions = run_prediction(question, [p.text for p in packs], model_name)
+    if first_request:
+        first_request = False
+        logging.warning(f'[INFO] - First reader request took {time.perf_counter() - start:.2f}s.')
     logging.info(_predictions)
     predictions = []
-    for prediction, m in zip(_predictions, meta):
-        _prediction = _predictions[prediction]
-        if _prediction != "" and _prediction != "empty":
-            predictions.append(dict(
-                answer = _prediction,
-                title = m['title'],
-                metadata_storage_name = m['metadata_storage_name'],
-                document_id = m['document_id'],
-                document_uri = m['document_uri']
-            ))
+    for (_prediction, _, answer_start), p in zip(_predictions, packs):
+        if _prediction != "":
+            predictions.append(format_answer(_prediction, meta[packing.locate(p, answer_start)]))
+    return predictions
+
+def main_batch(questions, documents, meta, model_name=None):
+    ''' Answers of many questions, with the documents and the metadata per question '''
+    packs = [pack(question, _documents, _meta, model_name) for question, _documents, _meta in zip(questions, documents, meta)]
+    _predictions = run_batch_prediction(questions, [[p.text for p in _packs] for _packs in packs], model_name)
+    predictions = []
+    for __predictions, _packs, _meta in zip(_predictions, packs, meta):
+        predictions.append([format_answer(_prediction, _meta[packing.locate(p, answer_start)]) for (_prediction, _, answer_start), p in zip(__predictions, _packs) if _prediction != ""])
     return predictions
 
+def main_adaptive(question, documents, meta, model_name=None):
+    ''' Answers of the adaptive reading mode, and the reader compute that was saved '''
+    _predictions, stats = run_adaptive_prediction(question, documents, model_name)
+    logging.warning(f'[INFO] - Adaptive reading saved {stats["compute_saved"]:.0%} of the reader compute.')
+    predictions = [format_answer(_prediction, m) for (_prediction, _, _), m in zip(_predictions, meta) if _prediction != ""]
+    return predictions, stats
+
+def stream(question, snippets, model_name=None, batch_size=2):
+    """
+    Read the snippets in small batches as they arrive and yield every answer
+    as soon as its batch is read.
+
+    Parameters
+    ----------
+    question : str
+
+    snippets : iterable[tuple[str, dict]]
+        Document and its metadata, e.g. from `retriever.stream`.
+
+    model_name : str, default None
+        Reader model, the default model if None.
+
+    batch_size : int, default 2
+        Snippets read per forward pass. Smaller batches yield the first
+        answers earlier, larger ones use the model better.
+
+    Yields
+    ------
+    answer : dict
+        Answer with the metadata of its document and its `score`.
+    """
+    batch = []
+    for snippet in snippets:
+        batch.append(snippet)
+        if len(batch) < batch_size:
+            continue
+        yield from read_batch(question, batch, model_name)
+        batch = []
+    if batch:
+        yield from read_batch(question, batch, model_name)
+
+def read_batch(question, batch, model_name=None):
+    for (answer, score, _), (_, m) in zip(run_prediction(question, [document for document, _ in batch], model_name), batch):
+        if answer != "":
+            yield format_answer(answer, m, score)
+
+# Warm up the default model in the background, so the worker starts right away
+if str(he.get_setting('reader', 'warm_up', 'true')).lower() == 'true':
+    threading.Thread(target=warm_up, name='mrc-warm-up', daemon=True).start()
+logging.warning(f'[INFO] - Reader started in {time.perf_counter() - startup:.2f}s.')
+
 if __name__ ==  '__main__':
     # Test question + context
     contexts = ["New Zealand (Māori: Aotearoa) is a sovereign island country in the southwestern Pacific Ocean. It has a total land area of 268,000 square kilometres (103,500 sq mi), and a population of 4.9 million. New Zealand's capital city is Wellington, and its most populous city is Auckland."]
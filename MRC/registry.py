@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+class ModelRegistry:
+    """
+    Loads reader models lazily on first use and keeps them resident, several
+    models at once. The least recently used models are evicted once the
+    resident models exceed the memory budget.
+
+    Parameters
+    ----------
+    loader : callable
+        Called as `loader(name)`, returns the loaded model. The model may
+        have a `size` attribute in bytes and a `close()` method, which is
+        called on eviction, once no request uses the model any more.
+
+    memory_budget : int, default None
+        Maximum bytes of all resident models, no limit if None. The model
+        used last is never evicted, even if it exceeds the budget alone.
+
+    Attributes
+    ----------
+    models_ : OrderedDict[str, object]
+        Resident models, least recently used first.
+
+    retired_ : dict[int, tuple[str, object]]
+        Name of the evicted models that are still in use, they are closed once the
+        last request that uses them is done.
+    """
+
+    def __init__(self, loader, memory_budget=None):
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.models_ = OrderedDict()
+        self.retired_ = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._users = {}
+
+    def get(self, name):
+        """
+        Get a model, loads it if it is not resident yet. Concurrent calls for
+        the same model wait for a single load. The model may be evicted and
+        closed at any time, use `use` to run it.
+
+        Parameters
+        ----------
+        name : str
+            Name or path of the model.
+
+        Returns
+        -------
+        model : object
+        """
+        return self._get(name, hold=False)
+
+    @contextmanager
+    def use(self, name):
+        ''' Model for the duration of the with block, it is not closed before the block ends, even if it is evicted meanwhile '''
+        model = self._get(name, hold=True)
+        try:
+            yield model
+        finally:
+            self._release(model)
+
+    def _get(self, name, hold):
+        with self._lock:
+            if name in self.models_:
+                self.models_.move_to_end(name)
+                return self._hold(self.models_[name], hold)
+            loading = self._loading.setdefault(name, threading.Lock())
+        with loading:
+            with self._lock:
+                if name in self.models_:
+                    self.models_.move_to_end(name)
+                    return self._hold(self.models_[name], hold)
+            start = time.perf_counter()
+            model = self.loader(name)
+            logging.warning(f'[INFO] - Loaded model {name} in {time.perf_counter() - start:.2f}s.')
+            with self._lock:
+                self.models_[name] = model
+                self._loading.pop(name, None)
+                self._hold(model, hold)
+                self._evict()
+            return model
+
+    def _hold(self, model, hold):
+        if hold:
+            self._users[id(model)] = self._users.get(id(model), 0) + 1
+        return model
+
+    def _release(self, model):
+        with self._lock:
+            self._users[id(model)] -= 1
+            if self._users[id(model)]:
+                return
+            del self._users[id(model)]
+            retired = self.retired_.pop(id(model), None)
+        if retired is not None and hasattr(model, 'close'):
+            model.close()
+            logging.warning(f'[INFO] - Closed the evicted model {retired[0]} after its last request.')
+
+    def _evict(self):
+        if not self.memory_budget:
+            return
+        while len(self.models_) > 1 and sum(getattr(model, 'size', 0) for model in self.models_.values()) > self.memory_budget:
+            name, model = self.models_.popitem(last=False)
+            if self._users.get(id(model)):
+                # Requests still run it, the last of them closes it
+                self.retired_[id(model)] = (name, model)
+            elif hasattr(model, 'close'):
+                model.close()
+            logging.warning(f'[INFO] - Evicted model {name} to stay within the memory budget.')
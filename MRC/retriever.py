@@ -1,9 +1,16 @@
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+import bisect
+import asyncio
 import logging
-from nltk import sent_tokenize
+import functools
+import threading
 import nltk.data
 import nltk.downloader
+from . import helper as he
+from . import telemetry
+from . import dedup
 
 try:
     nltk.data.path.append("./models/nltk/")
@@ -24,13 +31,39 @@ try:
     service_name = config['search']['service_name']
     index_name = config['search']['index_name']
     api_key = config['search']['key']
+    endpoint = config['search'].get('endpoint')
     logging.info('extracted keys from config')
 except Exception as e:
     logging.warning(f'{e}')
     service_name = os.environ.get('service_name')
     index_name = os.environ.get('index_name')
     api_key = os.environ.get('api_key')
+    endpoint = os.environ.get('endpoint')
     logging.info('extracted keys from environment')
+# The endpoint may point to another host for local testing, see tools/search_stub.py
+endpoint = endpoint or f"https://{service_name}.search.windows.net/"
+
+# Sentences of paragraphs and highlights, cached so that every text is tokenized once
+@functools.lru_cache(maxsize=int(he.get_setting('search', 'sentence_cache_size', 4096)))
+def get_sentences(text):
+    ''' Sentences of a text with their start and end offsets, and the first index of every distinct sentence '''
+    spans = list(nltk.data.load('tokenizers/punkt/english.pickle').span_tokenize(text))
+    sentences = [text[start:end] for start, end in spans]
+    first = {}
+    for i, sentence in enumerate(sentences):
+        first.setdefault(sentence, i)
+    return [start for start, _ in spans], [end for _, end in spans], sentences, first
+
+def find_sentence(highlight, text, starts, ends):
+    ''' Index of the first sentence that contains the highlight, None if none does '''
+    position = text.find(highlight)
+    while position != -1:
+        # The only sentence that may contain this occurrence is the last one starting before it
+        i = bisect.bisect_right(starts, position) - 1
+        if i >= 0 and position + len(highlight) <= ends[i]:
+            return i
+        position = text.find(highlight, position + 1)
+    return None
 
 # Extract relevant text parts
 def extract_relevant_text(highlight, paragraphs, tokenize):
@@ -38,59 +71,142 @@ def extract_relevant_text(highlight, paragraphs, tokenize):
     This ensures that we have better data for the MRC scoring, as not only partial sentences are extracted'''
     if not isinstance(paragraphs, list):
         paragraphs = [paragraphs]
+    if tokenize:
+        sentences = get_sentences(highlight)[2]
+        if not sentences:
+            return None
+        highlight = sentences[0]
     # For every highlight, look up the paragraphs
     for paragraph in paragraphs:
-        # If the highlight is in the respective paragraph, tokenize the sentences
-        if tokenize:
-            highlight = sent_tokenize(highlight)[0]
-        if highlight in paragraph:
-            sentences = sent_tokenize(paragraph)
-            # Loop through every sentence and detect the highlight
-            for sentence in sentences:
-                # As soon as we found the highlight, extract the sentences around it
-                if highlight in sentence:
-                    if sentences.index(sentence) == 0:
-                        return ". ".join(sentences[:2])
-                    elif sentences.index(sentence) == len(sentences) - 1:
-                        return ". ".join(sentences[-2:])
-                    else:
-                        return ". ".join(sentences[sentences.index(sentence)-1:sentences.index(sentence)+1])
+        # If the highlight is in the respective paragraph, look it up in the sentences of the paragraph
+        if highlight not in paragraph:
+            continue
+        starts, ends, sentences, first = get_sentences(paragraph)
+        i = find_sentence(highlight, paragraph, starts, ends)
+        if i is None:
+            continue
+        # As soon as we found the highlight, extract the sentences around its first occurrence
+        i = first[sentences[i]]
+        if i == 0:
+            return ". ".join(sentences[:2])
+        elif i == len(sentences) - 1:
+            return ". ".join(sentences[-2:])
+        else:
+            return ". ".join(sentences[i-1:i+1])
+
+# Clients are created once and reused, so connections are pooled across requests
+client = None
+client_lock = threading.Lock()
+# An async client is bound to the event loop it was created on, so there is one per loop
+async_clients = {}
+
+def get_client():
+    ''' Shared SearchClient, created on first use '''
+    global client
+    with client_lock:
+        if client is None:
+            client = SearchClient(endpoint=endpoint,
+                                index_name=index_name,
+                                credential=AzureKeyCredential(api_key))
+        return client
+
+async def get_async_client():
+    ''' Shared async SearchClient of the running event loop, created on first use, the clients of closed loops are closed '''
+    loop = asyncio.get_running_loop()
+    stale = []
+    with client_lock:
+        async_client = async_clients.get(loop)
+        if async_client is None:
+            stale = [async_clients.pop(other) for other in list(async_clients) if other.is_closed()]
+            async_client = async_clients[loop] = AsyncSearchClient(endpoint=endpoint,
+                                                                   index_name=index_name,
+                                                                   credential=AzureKeyCredential(api_key))
+    for other_client in stale:
+        try:
+            # Its connections were closed with its loop, closing it releases the session
+            await other_client.close()
+        except Exception as e:
+            logging.warning(f'[INFO] - Could not close the search client of a closed event loop: {e}')
+    return async_client
+
+# Characters per snippet, 0 keeps the whole snippet, the reader splits long ones into windows
+max_snippet_chars = int(he.get_setting('search', 'max_snippet_chars', 500))
+# Similarity from which a snippet counts as near duplicate of an earlier one, 0 drops exact duplicates only
+near_duplicate_threshold = float(he.get_setting('search', 'near_duplicate_threshold', 0.8))
+
+def truncate(text, max_chars):
+    ''' Cut the text to at most max_chars, after its last whole sentence, or its last whole word if the first sentence is longer '''
+    if not max_chars or len(text) <= max_chars:
+        return text
+    cut = text[:max_chars + 1]
+    end = max(cut.rfind('. '), cut.rfind('! '), cut.rfind('? '))
+    if end > 0:
+        return text[:end + 1]
+    space = cut.rfind(' ')
+    return text[:space] if space > 0 else text[:max_chars]
+
+search_options = dict(search_fields='paragraphs', highlight_fields='paragraphs-3', select='paragraphs,metadata_storage_name,document_id,document_uri,title')
+
+def get_snippets(result, threshold, tokenize, seen):
+    ''' Extract the relevant texts of a search result, yields the ones that are no (near) duplicate of a text in seen with their metadata '''
+    telemetry.count('retriever.results')
+    if result['@search.score'] > threshold:
+        if len(result['paragraphs']) == 0: 
+            return
+        search_highlights = list(dict.fromkeys(result['@search.highlights']['paragraphs']))
+        telemetry.count('retriever.highlights', len(search_highlights))
+        for highlight in search_highlights:
+            h = highlight.replace('<em>', '').replace('</em>', '')
+            with telemetry.span('retriever.extract'):
+                relevant_text = extract_relevant_text(h, result['paragraphs'], tokenize)
+            if relevant_text is None:
+                logging.info("Text is none, continue")
+                continue
+            # We only proceed with the first max_snippet_chars characters due to MRC limitations
+            relevant_text = truncate(relevant_text, max_snippet_chars)
+            meta = dict(
+                metadata_storage_name = result['metadata_storage_name'],
+                document_id = result['document_id'],
+                document_uri = result['document_uri'],
+                title = result['title']
+            )
+            # Results arrive best first, so the kept snippet is the one of the best result
+            if not seen.add(relevant_text, meta):
+                logging.info("Text already exists, continue")
+                telemetry.count('retriever.duplicates')
+                continue
+            telemetry.count('retriever.snippets')
+            yield relevant_text, meta
+
+def stream(question, n=5, threshold=5, tokenize=True):
+    ''' Yield the snippets and their metadata one by one, as the search results arrive '''
+    results = get_client().search(search_text=question, top=n, **search_options)
+    seen = dedup.SnippetIndex(near_duplicate_threshold)
+    for result in results:
+        yield from get_snippets(result, threshold, tokenize, seen)
 
 # Request to Cognitive Search
 def main(question, n=5, threshold=5, tokenize=True):
-    # Create a SearchClient to send queries
-    endpoint = f"https://{service_name}.search.windows.net/"
-    credential = AzureKeyCredential(api_key)
-    client = SearchClient(endpoint=endpoint,
-                        index_name=index_name,
-                        credential=credential)
-
     # Get top n results
-    results = client.search(search_text=question, search_fields='paragraphs', highlight_fields='paragraphs-3', select='paragraphs,metadata_storage_name,document_id,document_uri,title', top=n)
     documents = []
     meta = []
-    for result in results:
-        if result['@search.score'] > threshold:
-            if len(result['paragraphs']) == 0: 
-                continue
-            search_highlights = list(dict.fromkeys(result['@search.highlights']['paragraphs']))
-            for highlight in search_highlights:
-                h = highlight.replace('<em>', '').replace('</em>', '')
-                relevant_text = extract_relevant_text(h, result['paragraphs'], tokenize)
-                if relevant_text is None:
-                    logging.info("Text is none, continue")
-                    continue
-                # We only proceed with the first 500 characters due to MRC limitations
-                elif relevant_text[:500] in documents:
-                    logging.info("Text already exists, continue")
-                    continue
-                documents.append(relevant_text[:500])
-                meta.append(dict(
-                    metadata_storage_name = result['metadata_storage_name'],
-                    document_id = result['document_id'],
-                    document_uri = result['document_uri'],
-                    title = result['title']
-                ))
+    with telemetry.span('retriever'):
+        for document, m in stream(question, n, threshold, tokenize):
+            documents.append(document)
+            meta.append(m)
+    return documents, meta
+
+async def main_async(question, n=5, threshold=5, tokenize=True):
+    # Get top n results, without blocking the event loop while waiting for them
+    documents = []
+    meta = []
+    seen = dedup.SnippetIndex(near_duplicate_threshold)
+    with telemetry.span('retriever'):
+        results = await (await get_async_client()).search(search_text=question, top=n, **search_options)
+        async for result in results:
+            for document, m in get_snippets(result, threshold, tokenize, seen):
+                documents.append(document)
+                meta.append(m)
     return documents, meta
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+'''
+Timings and counters of the pipeline stages, per request.
+
+A request runs within a `trace`, the stages record their duration with `span` and
+their sizes with `count` and `observe`. Outside of a trace, these calls do nothing.
+Finished traces are handed to the exporter chosen with `exporter` in the `[telemetry]`
+section of the `config.ini`:
+    - `none`: traces are not exported
+    - `log`: the timings are logged
+    - `jsonl`: one line of timings per request is appended to the file at `path`
+    - `otlp`: the spans are appended to the file at `path` in the OTLP/JSON format of
+      OpenTelemetry, one request per line, e.g. for the `otlpjsonfile` receiver of the
+      OpenTelemetry Collector
+    - `<module>:<class>`: any class with an `export(trace)` method, created with `path`
+'''
+import json
+import time
+import logging
+import secrets
+import importlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from . import helper as he
+
+class Trace:
+    """
+    Spans and counters of one request.
+
+    Parameters
+    ----------
+    name : str
+        Name of the request, e.g. the function.
+
+    Attributes
+    ----------
+    trace_id_ : str
+        Random id, 32 hex digits like an OpenTelemetry trace id.
+
+    start_, end_ : int
+        Start and end of the request, nanoseconds since the epoch.
+
+    spans_ : list[tuple[str, int, int]]
+        Name, start and end of every span, nanoseconds since the epoch.
+
+    counters_ : dict[str, int]
+        Sum of the counts per name.
+
+    observations_ : dict[str, list[float]]
+        Observed values per name, e.g. the batch sizes of the reader.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id_ = secrets.token_hex(16)
+        self.start_ = time.time_ns()
+        self.end_ = None
+        self.spans_ = []
+        self.counters_ = {}
+        self.observations_ = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end):
+        with self._lock:
+            self.spans_.append((name, start, end))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters_[name] = self.counters_.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            self.observations_.setdefault(name, []).append(value)
+
+    def timings(self):
+        ''' Total milliseconds, milliseconds and calls per stage, counters and summaries of the observed values '''
+        with self._lock:
+            stages = {}
+            for name, start, end in self.spans_:
+                stage = stages.setdefault(name, dict(ms = 0.0, calls = 0))
+                stage['ms'] += (end - start) / 1e6
+                stage['calls'] += 1
+            for stage in stages.values():
+                stage['ms'] = round(stage['ms'], 3)
+            observations = {
+                name: dict(count = len(values), mean = round(sum(values) / len(values), 3), max = max(values))
+                for name, values in self.observations_.items()
+            }
+            return dict(
+                total_ms = round(((self.end_ or time.time_ns()) - self.start_) / 1e6, 3),
+                stages = stages,
+                counters = dict(self.counters_),
+                observations = observations
+            )
+
+_current = contextvars.ContextVar('mrc_trace', default=None)
+
+def current():
+    ''' Trace of the running request, None outside of a trace '''
+    return _current.get()
+
+@contextmanager
+def span(name):
+    ''' Record the duration of the block as a span of the current trace '''
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.time_ns())
+
+def count(name, value=1):
+    ''' Add to a counter of the current trace '''
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, value)
+
+def observe(name, value):
+    ''' Record a value of the current trace, e.g. a batch size '''
+    trace = _current.get()
+    if trace is not None:
+        trace.observe(name, value)
+
+def wrap(fn):
+    ''' Run fn within the current trace, also in another thread, e.g. of an executor '''
+    trace = _current.get()
+    def run(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+@contextmanager
+def trace(name):
+    ''' Trace the block as one request, the trace is exported at its end '''
+    _trace = Trace(name)
+    token = _current.set(_trace)
+    try:
+        yield _trace
+    finally:
+        _current.reset(token)
+        _trace.end_ = time.time_ns()
+        export(_trace)
+
+class LogExporter:
+    ''' Logs the timings of every trace '''
+
+    def __init__(self, path=None):
+        pass
+
+    def export(self, trace):
+        logging.warning(f'[INFO] - Timings of {trace.name} {trace.trace_id_}: {json.dumps(trace.timings())}')
+
+class JsonLinesExporter:
+    """
+    Appends the timings of every trace as one line of JSON to a file.
+
+    Parameters
+    ----------
+    path : str
+        File to append to, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(dict(trace_id = trace.trace_id_, name = trace.name, start = trace.start_, **trace.timings()))
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+class OtlpJsonExporter(JsonLinesExporter):
+    """
+    Appends the spans of every trace to a file in the OTLP/JSON format of
+    OpenTelemetry, one `ExportTraceServiceRequest` per line. The request is
+    the root span, with the counters as attributes, and the stages are its
+    children.
+
+    Parameters
+    ----------
+    path : str
+        File to append to, created if missing.
+
+    service_name : str, default 'mrc'
+        `service.name` of the resource.
+    """
+
+    def __init__(self, path, service_name='mrc'):
+        super().__init__(path)
+        self.service_name = service_name
+
+    def export(self, trace):
+        root_id = secrets.token_hex(8)
+        spans = [dict(
+            traceId = trace.trace_id_,
+            spanId = root_id,
+            name = trace.name,
+            kind = 2,
+            startTimeUnixNano = str(trace.start_),
+            endTimeUnixNano = str(trace.end_),
+            attributes = [dict(key = name, value = dict(intValue = str(value))) for name, value in trace.counters_.items()]
+        )]
+        for name, start, end in trace.spans_:
+            spans.append(dict(
+                traceId = trace.trace_id_,
+                spanId = secrets.token_hex(8),
+                parentSpanId = root_id,
+                name = name,
+                kind = 1,
+                startTimeUnixNano = str(start),
+                endTimeUnixNano = str(end)
+            ))
+        line = json.dumps(dict(resourceSpans = [dict(
+            resource = dict(attributes = [dict(key = 'service.name', value = dict(stringValue = self.service_name))]),
+            scopeSpans = [dict(scope = dict(name = 'MRC'), spans = spans)]
+        )]))
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+exporters = dict(log = LogExporter, jsonl = JsonLinesExporter, otlp = OtlpJsonExporter)
+
+def load_exporter(name, path=None):
+    ''' Exporter of a name in `exporters` or a `<module>:<class>`, None for `none` '''
+    if not name or name == 'none':
+        return None
+    if name in exporters:
+        return exporters[name](path)
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)(path)
+
+def set_exporter(_exporter):
+    ''' Replace the exporter, e.g. with one that collects the traces in tests '''
+    global exporter
+    exporter = _exporter
+
+def export(trace):
+    if exporter is None:
+        return
+    try:
+        exporter.export(trace)
+    except Exception as e:
+        logging.error(f'Export of trace {trace.trace_id_} failed: {e}')
+
+exporter = load_exporter(he.get_setting('telemetry', 'exporter', 'none'), he.get_setting('telemetry', 'path', 'traces.jsonl'))
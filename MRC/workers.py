@@ -0,0 +1,179 @@
+'''
+Reader worker pool, the `pool` backend of the reader.
+
+The forward passes run in separate processes, so they scale across cores instead of
+sharing the intra-op threads of one process. The weights of the model are exported once
+into a flat file, and every worker maps that file into its memory instead of loading a
+copy, so the operating system keeps the weights once in its page cache for all workers.
+The workers run this file by its path, so they never import the MRC package and its
+caches, statistics and models at module scope.
+'''
+import os
+import json
+import runpy
+import logging
+import itertools
+import threading
+import multiprocessing
+import torch
+from concurrent.futures import Future
+
+def export_weights(model, path):
+    ''' Write the float32 weights of the model into one flat file at path, and their offsets and shapes to path + `.json` '''
+    tensors = {}
+    offset = 0
+    with open(path, 'wb') as f:
+        for name, tensor in model.state_dict().items():
+            # Other buffers, e.g. position ids, are derived from the config when a worker builds the model
+            if tensor.dtype != torch.float32:
+                continue
+            f.write(tensor.detach().cpu().contiguous().numpy().tobytes())
+            tensors[name] = dict(offset = offset, shape = list(tensor.shape))
+            offset += tensor.numel()
+    with open(path + '.json', 'w') as f:
+        json.dump(dict(numel = offset, tensors = tensors), f)
+
+def map_weights(model, path):
+    ''' Replace the float32 weights of the model with views into the memory-mapped file of `export_weights` '''
+    with open(path + '.json') as f:
+        index = json.load(f)
+    # Private mapping: pages are read from the shared page cache and never written back
+    weights = torch.FloatTensor(torch.FloatStorage.from_file(path, False, index['numel']))
+    modules = dict(model.named_modules())
+    for name, entry in index['tensors'].items():
+        module_name, _, attribute = name.rpartition('.')
+        module = modules[module_name]
+        numel = 1
+        for dim in entry['shape']:
+            numel *= dim
+        tensor = weights[entry['offset']:entry['offset'] + numel].view(entry['shape'])
+        if attribute in module._parameters:
+            module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attribute] = tensor
+    return model
+
+def serve(model_class, config, weights_path, threads, cpus, tasks, results):
+    ''' Main loop of a worker process: run the forward passes of the tasks until it gets None '''
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    # The randomly initialized weights are freed as soon as they are replaced by the mapped ones
+    model = map_weights(model_class(config), weights_path)
+    model.eval()
+    results.put((None, os.getpid(), None, None))
+    for task_id, input_ids, attention_mask in iter(tasks.get, None):
+        try:
+            with torch.no_grad():
+                start_logits, end_logits = model(
+                    input_ids=torch.from_numpy(input_ids),
+                    attention_mask=torch.from_numpy(attention_mask)
+                )[:2]
+            results.put((task_id, start_logits.numpy(), end_logits.numpy(), None))
+        except Exception as e:
+            results.put((task_id, None, None, f'{type(e).__name__}: {e}'))
+
+class ReaderPool:
+    """
+    Runs the reader in a pool of worker processes, which share the weights
+    through one memory-mapped file, see `export_weights`.
+
+    Every worker takes one batch at a time from a shared queue, so up to
+    `processes` batches run at once. Workers are started one after another,
+    so only one of them holds its randomly initialized weights at a time.
+
+    Parameters
+    ----------
+    model_class : type
+        Question answering model class, built from the config in every worker.
+
+    config : transformers.PretrainedConfig
+        Config of the model.
+
+    weights_path : str
+        Flat weights file of `export_weights`.
+
+    processes : int, default None
+        Worker processes, the available cores divided by `threads` if None.
+
+    threads : int, default 1
+        Intra-op threads of every worker, see `torch.set_num_threads`.
+
+    pin : bool, default True
+        Pin every worker to its own `threads` cores, where the platform
+        supports it and there are enough cores.
+
+    timeout : float, default 60
+        Seconds a batch may take before it fails, e.g. if its worker died.
+    """
+
+    def __init__(self, model_class, config, weights_path, processes=None, threads=1, pin=True, timeout=60):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        self.processes = processes or max(1, len(cpus) // threads)
+        self.concurrency = self.processes
+        self.timeout = timeout
+        self.size = os.path.getsize(weights_path)
+        pin = pin and self.processes * threads <= len(cpus)
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = []
+        for i in range(self.processes):
+            worker = context.Process(
+                # A target of this module would import the MRC package in the worker, see the end of the file
+                target=runpy.run_path,
+                args=(os.path.abspath(__file__),),
+                kwargs=dict(
+                    init_globals=dict(worker_args=(model_class, config, weights_path, threads, cpus[i * threads:(i + 1) * threads] if pin else None, self._tasks, self._results)),
+                    run_name='__mrc_worker__'
+                ),
+                name=f'mrc-reader-{i}',
+                daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+            # Wait until the worker mapped the weights, before the next one allocates its own
+            self._results.get(timeout=600)
+        logging.warning(f'[INFO] - Started {self.processes} reader workers with {threads} threads each.')
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, name='mrc-reader-results', daemon=True)
+        self._collector.start()
+
+    def __call__(self, input_ids, attention_mask):
+        ''' Single forward pass of the reader on a padded batch in one of the workers, returns start and end logits '''
+        future = Future()
+        with self._lock:
+            task_id = next(self._ids)
+            self._futures[task_id] = future
+        self._tasks.put((task_id, input_ids.numpy(), attention_mask.numpy()))
+        try:
+            start_logits, end_logits = future.result(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._futures.pop(task_id, None)
+        return torch.from_numpy(start_logits), torch.from_numpy(end_logits)
+
+    def close(self):
+        ''' Stop the workers once they finished their current batch '''
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+        self._results.put(None)
+
+    def _collect(self):
+        for task_id, start_logits, end_logits, error in iter(self._results.get, None):
+            with self._lock:
+                future = self._futures.get(task_id)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(RuntimeError(f'Reader worker failed: {error}'))
+            else:
+                future.set_result((start_logits, end_logits))
+
+# Entry point of the worker processes of ReaderPool, which run this file by its path
+if __name__ == '__mrc_worker__':
+    serve(*worker_args)
@@ -0,0 +1,104 @@
+'''
+Micro-benchmarks of the pipeline stages, reported as JSON like `load.py`.
+
+    - `bm25`: `InvertedIndexBM25.fit` and `search_ids` on synthetic corpora of `--documents`
+      snippets, and `bm25.score` as called by the ranker
+    - `extraction`: `retriever.extract_relevant_text` on the highlights of the search stub,
+      cold (sentence cache cleared) and warm
+    - `reader`: `reader.run_prediction` on `assets/reader_fixtures.json`, without span cache,
+      the first call loads the model and is not counted
+
+The questions are taken from the recorded requests:
+    python benchmarks/components.py --stages bm25 extraction reader --repeat 10 --output components.json
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'tools'))
+import search_stub
+import report
+from load import read_requests, get_questions
+from MRC import bm25, retriever, cache
+
+def summary(seconds):
+    ''' Calls, latency and calls per second of a stage '''
+    return dict(calls = len(seconds), calls_per_s = round(len(seconds) / sum(seconds), 2) if sum(seconds) else None, latency = report.latency(seconds))
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def bench_bm25(questions, documents, n_documents, repeat, seed=0):
+    ''' Fit, search and score of BM25 on synthetic snippets made of the words of the documents '''
+    words = [word for document in documents for paragraph in document['paragraphs'] for word in paragraph.split()]
+    rng = random.Random(seed)
+    corpus = [" ".join(rng.choice(words) for _ in range(rng.randint(20, 120))) for _ in range(n_documents)]
+    # Scores depend on the corpus only, as for a worker without global statistics
+    bm25.corpus_statistics = None
+    fit, search, score = [], [], []
+    for _ in range(repeat):
+        normalizer = bm25.TextNormalizer()
+        texts = bm25.preprocess_text(corpus, normalizer)
+        index = bm25.InvertedIndexBM25()
+        fit.append(timed(index.fit, texts, None, normalizer))
+        for question in questions:
+            search.append(timed(index.search_ids, normalizer.transform(question)))
+            score.append(timed(bm25.score, question, corpus))
+    return dict(documents = n_documents, fit = summary(fit), search = summary(search), score = summary(score))
+
+def bench_extraction(questions, stub, repeat):
+    ''' Extraction of the relevant texts of the search results of every question '''
+    results = [result for question in questions for result in stub.search(question, 5)]
+    highlights = [
+        (highlight.replace('<em>', '').replace('</em>', ''), result['paragraphs'])
+        for result in results for highlight in result['@search.highlights']['paragraphs']
+    ]
+    cold, warm = [], []
+    for _ in range(repeat):
+        retriever.get_sentences.cache_clear()
+        for highlight, paragraphs in highlights:
+            cold.append(timed(retriever.extract_relevant_text, highlight, paragraphs, True))
+        for highlight, paragraphs in highlights:
+            warm.append(timed(retriever.extract_relevant_text, highlight, paragraphs, True))
+    return dict(highlights = len(highlights), cold = summary(cold), warm = summary(warm))
+
+def bench_reader(fixtures, repeat):
+    ''' Predictions of the reader for the contexts of every fixture '''
+    from MRC import reader
+    cache.spans = None
+    load_s = timed(reader.run_prediction, fixtures[0]['question'], fixtures[0]['contexts'])
+    seconds = [
+        timed(reader.run_prediction, fixture['question'], fixture['contexts'])
+        for _ in range(repeat) for fixture in fixtures
+    ]
+    return dict(model = reader.default_model, contexts = sum(len(fixture['contexts']) for fixture in fixtures), load_s = round(load_s, 3), run_prediction = summary(seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the pipeline stages.')
+    parser.add_argument('--stages', nargs='+', default=['bm25', 'extraction'], choices=['bm25', 'extraction', 'reader'])
+    parser.add_argument('--requests', default='assets/benchmark_requests.jsonl', help='recorded requests, their questions are used')
+    parser.add_argument('--search-documents', default='assets/search_documents.json', help='documents of the search stub')
+    parser.add_argument('--fixtures', default='assets/reader_fixtures.json', help='questions and contexts of the reader')
+    parser.add_argument('--documents', type=int, default=100, help='snippets per BM25 corpus')
+    parser.add_argument('--repeat', type=int, default=10, help='passes over the questions')
+    parser.add_argument('--output', default=None, help='JSON file of the report, printed in any case')
+    args = parser.parse_args()
+
+    questions = list(dict.fromkeys(get_questions(read_requests(args.requests))))
+    stub = search_stub.load_stub(args.search_documents)
+    result = dict(environment = report.environment(dict(questions = len(questions), repeat = args.repeat)))
+    if 'bm25' in args.stages:
+        result['bm25'] = bench_bm25(questions, stub.documents, args.documents, args.repeat)
+    if 'extraction' in args.stages:
+        result['extraction'] = bench_extraction(questions, stub, args.repeat)
+    if 'reader' in args.stages:
+        with open(args.fixtures, encoding='utf-8') as f:
+            result['reader'] = bench_reader(json.load(f), args.repeat)
+    result['peak_rss_mb'] = report.peak_rss_mb()
+    report.write(result, args.output)
@@ -0,0 +1,97 @@
+'''
+Micro-benchmark of the sentence extraction of the retriever, on synthetic long documents.
+
+Compares `retriever.extract_relevant_text` with the previous implementation, which
+tokenized the highlight and the paragraphs again for every highlight, and checks
+that both extract the same texts. The highlights of a result are mostly taken from
+the same paragraph, like the highlights of Azure Search, and the results are
+extracted `--repeat` times, like documents that are found for several questions.
+The first pass is reported as cold, the others as warm:
+    python benchmarks/extraction.py --paragraphs 20 --sentences 200 --highlights 3 --repeat 3
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from nltk import sent_tokenize
+from MRC import retriever
+
+words = ("azure search machine reading comprehension answers questions about documents model reader "
+    "retriever ranking paragraph sentence highlight index service cloud language transformer").split()
+
+def extract_relevant_text_reference(highlight, paragraphs, tokenize):
+    ''' Previous implementation of retriever.extract_relevant_text '''
+    if not isinstance(paragraphs, list):
+        paragraphs = [paragraphs]
+    for paragraph in paragraphs:
+        if tokenize:
+            highlight = sent_tokenize(highlight)[0]
+        if highlight in paragraph:
+            sentences = sent_tokenize(paragraph)
+            for sentence in sentences:
+                if highlight in sentence:
+                    if sentences.index(sentence) == 0:
+                        return ". ".join(sentences[:2])
+                    elif sentences.index(sentence) == len(sentences) - 1:
+                        return ". ".join(sentences[-2:])
+                    else:
+                        return ". ".join(sentences[sentences.index(sentence)-1:sentences.index(sentence)+1])
+
+def get_sentence(rng):
+    return " ".join(rng.choice(words) for _ in range(rng.randint(6, 20))).capitalize() + "."
+
+def get_results(n_results, n_paragraphs, n_sentences, n_highlights, seed=0):
+    ''' Synthetic search results, with highlights taken from their paragraphs '''
+    rng = random.Random(seed)
+    results = []
+    for _ in range(n_results):
+        paragraphs = [" ".join(get_sentence(rng) for _ in range(n_sentences)) for _ in range(n_paragraphs)]
+        highlights = []
+        paragraph = rng.choice(paragraphs)
+        for _ in range(n_highlights):
+            sentence = rng.choice(sent_tokenize(paragraph if rng.random() < 0.8 else rng.choice(paragraphs)))
+            highlights.append(" ".join(sentence.split()[:rng.randint(3, 8)]))
+        results.append((highlights, paragraphs))
+    return results
+
+def run(extract, results, tokenize, repeat=1):
+    ''' Extracted texts of the first pass, and the seconds of every pass '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        texts = [extract(highlight, paragraphs, tokenize) for highlights, paragraphs in results for highlight in highlights]
+        times.append(time.perf_counter() - start)
+    return texts, times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the sentence extraction of the retriever.')
+    parser.add_argument('--results', type=int, default=50, help='search results')
+    parser.add_argument('--paragraphs', type=int, default=20, help='paragraphs per result')
+    parser.add_argument('--sentences', type=int, default=200, help='sentences per paragraph')
+    parser.add_argument('--highlights', type=int, default=3, help='highlights per result')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the same results')
+    args = parser.parse_args()
+    results = get_results(args.results, args.paragraphs, args.sentences, args.highlights)
+    report = dict(vars(args))
+    for tokenize in (True, False):
+        retriever.get_sentences.cache_clear()
+        reference, reference_times = run(extract_relevant_text_reference, results, tokenize, args.repeat)
+        texts, extract_times = run(retriever.extract_relevant_text, results, tokenize, args.repeat)
+        report[f'tokenize={tokenize}'] = dict(
+            reference_cold_s = round(reference_times[0], 4),
+            extract_cold_s = round(extract_times[0], 4),
+            speedup_cold = round(reference_times[0] / extract_times[0], 1),
+            identical = texts == reference
+        )
+        if args.repeat > 1:
+            reference_warm, extract_warm = sum(reference_times[1:]) / (args.repeat - 1), sum(extract_times[1:]) / (args.repeat - 1)
+            report[f'tokenize={tokenize}'].update(
+                reference_warm_s = round(reference_warm, 4),
+                extract_warm_s = round(extract_warm, 4),
+                speedup_warm = round(reference_warm / extract_warm, 1)
+            )
+    print(json.dumps(report, indent=4))
@@ -0,0 +1,144 @@
+'''
+End-to-end load test of the function, driven by recorded requests.
+
+Starts the search stub of `tools/search_stub.py` in the process, points the retriever
+to it and sends the request bodies of a JSONL file (one JSON object or question per
+line, e.g. `assets/benchmark_requests.jsonl`) or of a Postman collection to `MRC.main`
+from `--concurrency` threads, or to `MRC.main_async` on one event loop with `--async`.
+The requests are repeated until `--total` requests are sent. Reports the latency
+percentiles, the requests per second and the peak memory as JSON:
+    python benchmarks/load.py --total 200 --concurrency 8 --latency 0.05 --output load.json
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'tools'))
+import azure.functions as func
+import search_stub
+import report
+
+def read_requests(path):
+    ''' Request bodies of a JSONL file, or of the requests of a Postman collection '''
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.postman_collection.json'):
+            requests = [item['request'] for item in json.load(f)['item']]
+            return [json.loads(request['body']['raw']) for request in requests if request.get('body', {}).get('raw')]
+        bodies = []
+        for line in f:
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            bodies.append(body if isinstance(body, dict) else dict(question = body))
+        return bodies
+
+def get_questions(bodies):
+    ''' Questions of the request bodies, including those of batch requests '''
+    questions = []
+    for body in bodies:
+        questions.extend(body.get('questions') or [body['question']])
+    return questions
+
+def get_request(body):
+    return func.HttpRequest(
+        method='POST',
+        url='/api/MRC',
+        headers={'Content-Type': 'application/json'},
+        params={},
+        body=json.dumps(body).encode('utf-8')
+    )
+
+def send(MRC, body):
+    ''' Seconds of one request to `MRC.main`, and whether it succeeded '''
+    start = time.perf_counter()
+    try:
+        ok = MRC.main(get_request(body)).status_code == 200
+    except Exception as e:
+        logging.error(f'Request {body} failed: {e}')
+        ok = False
+    return time.perf_counter() - start, ok
+
+async def send_async(MRC, body, semaphore):
+    ''' Seconds of one request to `MRC.main_async`, and whether it succeeded '''
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            ok = (await MRC.main_async(get_request(body))).status_code == 200
+        except Exception as e:
+            logging.error(f'Request {body} failed: {e}')
+            ok = False
+        return time.perf_counter() - start, ok
+
+def run(MRC, bodies, concurrency, use_async=False):
+    ''' Seconds and success per request, and the seconds of the whole run '''
+    start = time.perf_counter()
+    if use_async:
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*[send_async(MRC, body, semaphore) for body in bodies])
+        results = asyncio.run(run_all())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as pool:
+            results = list(pool.map(lambda body: send(MRC, body), bodies))
+    return results, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end load test of the function on the search stub.')
+    parser.add_argument('--requests', default='assets/benchmark_requests.jsonl', help='JSONL file of request bodies, or a Postman collection')
+    parser.add_argument('--total', type=int, default=100, help='requests to send, the recorded ones are repeated')
+    parser.add_argument('--concurrency', type=int, default=4, help='requests in flight at once')
+    parser.add_argument('--warm-up', type=int, default=5, help='requests sent one by one before the run, not counted')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='send the requests to main_async')
+    parser.add_argument('--documents', default='assets/search_documents.json', help='documents of the search stub')
+    parser.add_argument('--recorded', default=None, help='recorded search results, replayed by the search stub')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every search request is delayed')
+    parser.add_argument('--no-cache', action='store_true', help='turn the answer and span caches off')
+    parser.add_argument('--output', default=None, help='JSON file of the report, printed in any case')
+    args = parser.parse_args()
+
+    stub = search_stub.load_stub(args.documents, args.recorded, args.latency)
+    server, endpoint = search_stub.start_server(stub)
+    import MRC
+    from MRC import retriever, reader, cache, dense, helper
+    # Point the retriever to the stub, any index and key are accepted
+    retriever.endpoint = endpoint
+    retriever.index_name = retriever.index_name or 'stub'
+    retriever.api_key = retriever.api_key or 'stub'
+    retriever.client = None
+    if args.no_cache:
+        cache.answers = None
+        cache.spans = None
+
+    bodies = read_requests(args.requests)
+    for body in bodies[:args.warm_up]:
+        send(MRC, body)
+    stub.requests_ = 0
+    results, duration = run(MRC, [bodies[i % len(bodies)] for i in range(args.total)], args.concurrency, args.use_async)
+    server.shutdown()
+
+    seconds = [seconds for seconds, ok in results if ok]
+    report.write(dict(
+        environment = report.environment(dict(
+            model = reader.default_model,
+            backend = helper.get_setting('reader', 'backend', 'pytorch'),
+            max_batch_size = int(helper.get_setting('reader', 'max_batch_size', 16)),
+            cache = cache.answers is not None,
+            dense = dense.enabled,
+            entry_point = 'main_async' if args.use_async else 'main',
+            concurrency = args.concurrency,
+            search_latency_s = args.latency
+        )),
+        requests = len(results),
+        errors = len(results) - len(seconds),
+        duration_s = round(duration, 3),
+        requests_per_s = round(len(results) / duration, 2),
+        latency = report.latency(seconds),
+        search_requests = stub.requests_,
+        peak_rss_mb = report.peak_rss_mb()
+    ), args.output)
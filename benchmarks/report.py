@@ -0,0 +1,44 @@
+'''
+Shared measures of the benchmarks: latency percentiles, throughput and peak memory,
+reported as JSON so that runs can be compared across models and settings.
+'''
+import sys
+import json
+import platform
+import numpy as np
+
+def latency(seconds):
+    ''' Percentiles, mean and maximum of the latencies, in milliseconds '''
+    if not len(seconds):
+        return dict(p50_ms = None, p95_ms = None, p99_ms = None, mean_ms = None, max_ms = None)
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return dict(
+        p50_ms = round(float(p50), 3),
+        p95_ms = round(float(p95), 3),
+        p99_ms = round(float(p99), 3),
+        mean_ms = round(float(ms.mean()), 3),
+        max_ms = round(float(ms.max()), 3)
+    )
+
+def peak_rss_mb():
+    ''' Peak resident memory of the process in MiB, None where the platform does not report it '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+def environment(settings=None):
+    ''' Python, platform and the given settings, to tell runs apart '''
+    return dict(python = platform.python_version(), platform = platform.platform(), **(settings or {}))
+
+def write(report, path=None):
+    ''' Print the report as JSON, and write it to the path if given '''
+    text = json.dumps(report, indent=4)
+    print(text)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
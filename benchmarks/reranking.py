@@ -0,0 +1,75 @@
+'''
+Recall and reader time of the ranking stages, on the fixtures of `assets/ranking_fixtures.json`.
+
+Every fixture has a question, its snippets and the answer. A question counts as
+recalled at k if one of the k best snippets contains the answer. The snippets are
+ranked in their given order (as returned by the search), with BM25, with the dense
+encoder alone and with both fused (hybrid). With `--read`, the reader reads the k
+best snippets of every ranking and all snippets, and the reader time is reported:
+    python benchmarks/reranking.py --k 1 2 3 --read
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from MRC import bm25, dense, cache, ranker
+
+def rank(method, question, snippets):
+    ''' Order of the snippets of a ranking method '''
+    if method == 'search':
+        return np.arange(len(snippets))
+    elif method == 'bm25':
+        scores = bm25.score(question, snippets)
+    elif method == 'dense':
+        scores = dense.score(question, snippets)
+    else:
+        scores = dense.reciprocal_rank_fusion([bm25.score(question, snippets), dense.score(question, snippets)], ranker.rrf_k)
+    return bm25.top_k(scores, len(snippets))
+
+def read(fixtures, candidates):
+    ''' Seconds the reader takes for the candidates of every fixture, and the share of found answers '''
+    from MRC import reader
+    start = time.perf_counter()
+    found = 0
+    for fixture, snippets in zip(fixtures, candidates):
+        answers = [answer for answer, _, _ in reader.run_prediction(fixture['question'], snippets)]
+        found += any(answer and (answer in fixture['answer'] or fixture['answer'] in answer) for answer in answers)
+    return time.perf_counter() - start, found / len(fixtures)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall and reader time of the ranking stages.')
+    parser.add_argument('--fixtures', default='assets/ranking_fixtures.json')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--methods', nargs='+', default=['search', 'bm25', 'dense', 'hybrid'])
+    parser.add_argument('--read', action='store_true', help='time the reader on the k best snippets')
+    args = parser.parse_args()
+    with open(args.fixtures, encoding='utf-8') as f:
+        fixtures = json.load(f)
+    # Rank and read every fixture from scratch
+    bm25.corpus_statistics = None
+    cache.spans = None
+
+    start = time.perf_counter()
+    dense.embed([snippet for fixture in fixtures for snippet in fixture['snippets']])
+    report = dict(fixtures = len(fixtures), embedding_s = round(time.perf_counter() - start, 4))
+    if args.read:
+        # The first read loads the model, it is not counted
+        read(fixtures[:1], [fixtures[0]['snippets']])
+        reader_s, found = read(fixtures, [fixture['snippets'] for fixture in fixtures])
+        report['all'] = dict(candidates = sum(len(fixture['snippets']) for fixture in fixtures), reader_s = round(reader_s, 4), found = found)
+    for method in args.methods:
+        start = time.perf_counter()
+        orders = [rank(method, fixture['question'], fixture['snippets']) for fixture in fixtures]
+        report[method] = dict(ranking_s = round(time.perf_counter() - start, 4))
+        for k in args.k:
+            recalled = [any(fixture['answer'] in fixture['snippets'][i] for i in order[:k]) for fixture, order in zip(fixtures, orders)]
+            result = dict(recall = sum(recalled) / len(fixtures))
+            if args.read:
+                reader_s, found = read(fixtures, [[fixture['snippets'][i] for i in order[:k]] for fixture, order in zip(fixtures, orders)])
+                result.update(candidates = k * len(fixtures), reader_s = round(reader_s, 4), found = found)
+            report[method][f'k={k}'] = result
+    print(json.dumps(report, indent=4))
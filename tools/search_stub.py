@@ -0,0 +1,129 @@
+'''
+Local stand-in for the Azure Cognitive Search API, for testing and benchmarking without a search service.
+
+It answers the search requests of the SearchClient (sync and async) with results from a local
+set of documents: documents are scored by the number of question terms in their paragraphs, and
+the sentences with a term are returned as highlights. Recorded responses may be replayed instead,
+for the questions they were recorded for.
+
+Run it and point the retriever to it with `endpoint=http://localhost:7072/` in the `[search]`
+section of the `config.ini`, any `index_name` and `key` are accepted:
+    python tools/search_stub.py --port 7072 --documents assets/search_documents.json --latency 0.05
+'''
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stopwords = set(["a", "an", "the", "is", "are", "was", "of", "in", "on", "to", "and", "or", "for", "who", "what", "when", "where", "how", "which", "does", "do", "did"])
+
+class SearchStub:
+    """
+    Search results of the stub.
+
+    Parameters
+    ----------
+    documents : list[dict]
+        Documents with `paragraphs`, `metadata_storage_name`, `document_id`,
+        `document_uri` and `title`.
+
+    recorded : dict[str, list[dict]], default None
+        Recorded results per search text, returned as they are.
+
+    latency : float, default 0.0
+        Seconds every request is delayed, to imitate the round trip.
+    """
+
+    def __init__(self, documents, recorded=None, latency=0.0):
+        self.documents = documents
+        self.recorded = recorded or {}
+        self.latency = latency
+        self.requests_ = 0
+
+    def search(self, search_text, top=50):
+        ''' Results for the search text, as in the `value` of the search API response '''
+        self.requests_ += 1
+        if search_text in self.recorded:
+            return self.recorded[search_text][:top]
+        terms = [term for term in re.findall(r'\w+', search_text.lower()) if term not in stopwords]
+        pattern = re.compile(r'\b(' + '|'.join(map(re.escape, terms)) + r')\b', re.IGNORECASE) if terms else None
+        results = []
+        for document in self.documents:
+            if pattern is None:
+                break
+            highlights = []
+            score = 0
+            for paragraph in document['paragraphs']:
+                for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+                    matches = pattern.findall(sentence)
+                    if matches:
+                        score += len(matches)
+                        highlights.append(pattern.sub(r'<em>\1</em>', sentence))
+            if score:
+                result = dict(document)
+                # Scale the score, so that the default threshold of the retriever keeps good matches
+                result['@search.score'] = 2.0 * score
+                result['@search.highlights'] = dict(paragraphs = highlights[:3])
+                results.append(result)
+        results.sort(key=lambda result: result['@search.score'], reverse=True)
+        return results[:top]
+
+class Server(ThreadingHTTPServer):
+    # Accept many concurrent connections, e.g. of a load test
+    daemon_threads = True
+    request_queue_size = 128
+
+def get_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not self.path.split('?')[0].endswith('/docs/search.post.search'):
+                return self.respond(404, dict(error = dict(code = 'NotFound', message = self.path)))
+            if stub.latency:
+                time.sleep(stub.latency)
+            self.respond(200, {'value': stub.search(body.get('search') or '', body.get('top') or 50)})
+
+        def respond(self, status, payload):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; odata.metadata=none')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+    return Handler
+
+def start_server(stub, host='localhost', port=0):
+    ''' Serve the stub in a background thread, returns the server and its endpoint '''
+    server = Server((host, port), get_handler(stub))
+    threading.Thread(target=server.serve_forever, name='search-stub', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}/'
+
+def load_stub(documents_path, recorded_path=None, latency=0.0):
+    ''' Stub with the documents and the recorded results of the given files '''
+    with open(documents_path, encoding='utf-8') as f:
+        documents = json.load(f)
+    recorded = None
+    if recorded_path:
+        with open(recorded_path, encoding='utf-8') as f:
+            recorded = json.load(f)
+    return SearchStub(documents, recorded, latency)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Azure Cognitive Search API.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=7072)
+    parser.add_argument('--documents', default='assets/search_documents.json', help='documents to search')
+    parser.add_argument('--recorded', default=None, help='recorded results per search text, replayed as they are')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request is delayed')
+    args = parser.parse_args()
+    server = Server((args.host, args.port), get_handler(load_stub(args.documents, args.recorded, args.latency)))
+    print(f'Search stub listening on http://{args.host}:{args.port}/')
+    server.serve_forever()